@@ -1,43 +1,156 @@
 import argparse
+import csv
+import gzip
+import hashlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import orjson
 import requests
-import pandas
-
-from oauth2client.client import GoogleCredentials
-
-
-# function to get authorization bearer token for requests
-def get_access_token():
-    """Get access token."""
-
-    scopes = ["https://www.googleapis.com/auth/userinfo.profile", "https://www.googleapis.com/auth/userinfo.email"]
-    credentials = GoogleCredentials.get_application_default()
-    credentials = credentials.create_scoped(scopes)
-
-    return credentials.get_access_token().access_token
-
-
-def call_rawls_batch_upsert(workspace_name, project, request):
-    """Post entities to Terra workspace using batchUpsert."""
-
-    # rawls request URL for batchUpsert
-    uri = f"https://rawls.dsde-prod.broadinstitute.org/api/workspaces/{project}/{workspace_name}/entities/batchUpsert"
-
-    print("this is the request", request)
-    # Get access token and and add to headers for requests.
-    # -H  "accept: */*" -H  "Authorization: Bearer [token] -H "Content-Type: application/json"
-    headers = {"Authorization": "Bearer " + get_access_token(), "accept": "*/*", "Content-Type": "application/json"}
-
-    # capture response from API and parse out status code
-    response = requests.post(uri, headers=headers, data=request)
-    status_code = response.status_code
-
-    if status_code != 204:  # entities upsert fail
-        print(f"WARNING: Failed to upload entities.")
-        print(response.text)
-        return
-
-    # entities upsert success
-    print(f"Successfully uploaded entities." + "\n")
+from requests.adapters import HTTPAdapter
+
+from src.services.backoff import decorrelated_jitter
+from src.services.credentials import get_access_token
+from src.services.terra import TerraAPIWrapper
+
+RAWLS_BATCH_UPSERT_URL = "https://rawls.dsde-prod.broadinstitute.org/api/workspaces/{project}/{workspace_name}/entities/batchUpsert"
+CHUNK_MAX_ENTITIES = 1000
+CHUNK_MAX_BYTES = 5 * 1024 * 1024  # stay well under the request size limit
+MAX_UPLOAD_WORKERS = 4
+MAX_CHUNK_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2  # in seconds
+RETRY_MAX_DELAY = 60  # in seconds
+# chunks built but not yet uploaded, per worker - bounds memory when entities come from a generator
+MAX_PENDING_CHUNKS_PER_WORKER = 2
+GZIP_COMPRESS_LEVEL = 6
+REQUEST_TIMEOUT = (10, 300)  # (connect, read) in seconds
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class UpsertResumeFile:
+    """Append-only record of the chunks rawls has accepted, keyed by a hash of the chunk body, so a rerun
+    of the same load file only sends the chunks that did not succeed"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.completed = {line.strip() for line in f if line.strip()}
+
+    def record(self, chunk_hash):
+        with self._lock, open(self.path, "a") as f:
+            f.write(chunk_hash + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.completed.add(chunk_hash)
+
+
+def chunk_entities(entities, max_entities=CHUNK_MAX_ENTITIES, max_bytes=CHUNK_MAX_BYTES):
+    """Yields request bodies (bytes) of at most max_entities entities and roughly max_bytes each.
+    An entity larger than max_bytes is sent in a chunk of its own."""
+    parts, size = [], 2  # the enclosing []
+    for entity in entities:
+        part = orjson.dumps(entity)
+        if parts and (len(parts) >= max_entities or size + len(part) + 1 > max_bytes):
+            yield b"[" + b",".join(parts) + b"]"
+            parts, size = [], 2
+        parts.append(part)
+        size += len(part) + 1
+    if parts:
+        yield b"[" + b",".join(parts) + b"]"
+
+
+def upload_chunk(session, uri, body, compress=False):
+    """POST one chunk to batchUpsert, retrying throttled, failed or dropped requests. Returns (succeeded, message)."""
+    retry_delays = decorrelated_jitter(base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY)
+    if compress:
+        body = gzip.compress(body, compresslevel=GZIP_COMPRESS_LEVEL)
+
+    for attempt in range(1, MAX_CHUNK_ATTEMPTS + 1):
+        headers = {"Authorization": "Bearer " + get_access_token(), "accept": "*/*", "Content-Type": "application/json"}
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+        try:
+            response = session.post(uri, headers=headers, data=body, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            message = f"request failed: {e}"
+        else:
+            if response.status_code == 204:
+                return True, f"uploaded after {attempt} attempt(s)"
+            message = f"status {response.status_code}: {response.text}"
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return False, message
+
+        if attempt < MAX_CHUNK_ATTEMPTS:
+            retry_delay = next(retry_delays)
+            print(f"WARNING: {message}. Retrying in {retry_delay:.1f} seconds")
+            time.sleep(retry_delay)
+
+    return False, f"gave up after {MAX_CHUNK_ATTEMPTS} attempts, last error was {message}"
+
+
+def call_rawls_batch_upsert(workspace_name, project, entities, resume_file=None, max_workers=MAX_UPLOAD_WORKERS,
+                            max_entities=CHUNK_MAX_ENTITIES, max_bytes=CHUNK_MAX_BYTES, compress=False):
+    """Post entities to Terra workspace using batchUpsert, in chunks sent in parallel.
+
+    entities can be a generator - only a few chunks per worker are built ahead of the uploads. Returns the
+    number of chunks that could not be uploaded. With a resume_file, chunks uploaded by an earlier run are
+    skipped and every chunk that succeeds is recorded. With compress, chunk bodies are sent gzipped.
+    """
+
+    uri = RAWLS_BATCH_UPSERT_URL.format(project=project, workspace_name=workspace_name)
+    resume = UpsertResumeFile(resume_file) if resume_file else None
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=max_workers))
+
+    failed_chunks = 0
+    skipped_chunks = 0
+    sent_chunks = 0
+
+    def report(done):
+        nonlocal failed_chunks
+        for future in done:
+            chunk_number, chunk_hash = pending.pop(future)
+            succeeded, message = future.result()
+            if succeeded:
+                print(f"Chunk {chunk_number}: {message}")
+                if resume:
+                    resume.record(chunk_hash)
+            else:
+                failed_chunks += 1
+                print(f"ERROR: Chunk {chunk_number} failed to upload: {message}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for chunk_number, body in enumerate(chunk_entities(entities, max_entities, max_bytes), start=1):
+            # the hash is of the uncompressed body, so the resume file works with or without compression
+            chunk_hash = hashlib.sha256(body).hexdigest()
+            if resume and chunk_hash in resume.completed:
+                skipped_chunks += 1
+                continue
+
+            if len(pending) >= max_workers * MAX_PENDING_CHUNKS_PER_WORKER:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                report(done)
+            pending[executor.submit(upload_chunk, session, uri, body, compress)] = (chunk_number, chunk_hash)
+            sent_chunks += 1
+
+        done, _ = wait(pending)
+        report(done)
+
+    if skipped_chunks:
+        print(f"Skipped {skipped_chunks} chunks already uploaded by a previous run")
+    if failed_chunks:
+        print(f"WARNING: {failed_chunks} of {sent_chunks} chunks failed to upload.")
+    else:
+        print(f"Successfully uploaded entities." + "\n")
+    return failed_chunks
 
 
 def write_request_json(request, filename_prefix):
@@ -58,99 +171,237 @@ def convert_string_to_list(input_string):
 
 
 def create_list_attr_operation(var_attribute_list_name):
-    """Return request string for a single operation to create an attribute of type array/list."""
+    """Return a single operation to create an attribute of type array/list."""
 
-    return '{"op":"CreateAttributeValueList","attributeName":"' + var_attribute_list_name + '"},'
+    return {"op": "CreateAttributeValueList", "attributeName": var_attribute_list_name}
 
 
 def add_list_member_operation(var_attribute_list_name, var_attribute_list_member):
-    """Return request string for a single operation to add a list member to an attribute of type array/list."""
+    """Return a single operation to add a list member to an attribute of type array/list."""
 
-    return '{"op":"AddListMember","attributeListName":"' + var_attribute_list_name + '", "newMember":"' + var_attribute_list_member + '"},'
+    return {"op": "AddListMember", "attributeListName": var_attribute_list_name, "newMember": var_attribute_list_member}
 
 
 def create_non_array_attr_operation(var_attribute_name, var_attribute_value):
-    """Return request string for a single operation to create a non-array attribute."""
+    """Return a single operation to create a non-array attribute."""
 
-    return '{"op":"AddUpdateAttribute","attributeName":"' + var_attribute_name + '", "addUpdateAttribute":"' + var_attribute_value + '"},'
+    return {"op": "AddUpdateAttribute", "attributeName": var_attribute_name, "addUpdateAttribute": var_attribute_value}
 
 
 def create_single_entity_request(var_entity_id, var_entity_type, single_entity_operations):
-    """Return request string with array/list attributes, their associated values/members, and single entity operations."""
+    """Return the request for one entity with array/list attributes, their associated values/members, and single entity operations."""
 
-    return '{"name":"' + var_entity_id + '", "entityType":"' + var_entity_type + '", "operations":[' + single_entity_operations + ']}'
+    return {"name": var_entity_id, "entityType": var_entity_type, "operations": single_entity_operations}
 
 
-def create_upsert_request(tsv, array_attr_cols=None):
-    """Generate the request body for batchUpsert API."""
+def create_array_attr_operations(col, values):
+    """Return the operations of one array column, one list per row. Empty cells get no operations."""
+
+    operations = []
+    for value in values:
+        if value is None:
+            operations.append([])
+            continue
+        # convert string value -> back into an array: [foo,bar] (str) --> ['foo', 'bar'] (list)
+        operations.append(
+            [create_list_attr_operation(col)] + [add_list_member_operation(col, val) for val in convert_string_to_list(value)]
+        )
+    return operations
+
+
+def create_non_array_attr_operations(col, values):
+    """Return the operations of one non-array column, one list per row. Empty cells get no operations."""
+
+    return [[] if value is None else [create_non_array_attr_operation(col, value)] for value in values]
+
+
+def get_entity_type(entity_type_col_name):
+    """Return the table name from the first column of a load tsv, or None if the column isn't entity:/membership:"""
 
-    tsv = pandas.read_csv(tsv, sep='\t')
     # check tsv format: data model load tsv requirement "entity:table_name_id" or "membership:table_name_id" -> else exit
-    entity_type_col_name = tsv.columns[0]
+    if not entity_type_col_name.startswith(("entity:", "membership:")):
+        print("Invalid tsv. The .tsv does not start with column entity:[table_name]_id or membership:[table_name]_id. Please correct and try again.")
+        return None
+
     entity_type = entity_type_col_name.split(":")[1].split("_")[0]  # entity_name
     print("entitiy type", entity_type)
-    # initiate string to capture all operation requests for all rows (entities) in given tsv file
-    all_entities_request = []
+    return entity_type
 
-    if not entity_type_col_name.startswith(("entity:", "membership:")):
-        print("Invalid tsv. The .tsv does not start with column entity:[table_name]_id or membership:[table_name]_id. Please correct and try again.")
+
+def iter_upsert_entities(tsv, array_attr_cols=None):
+    """Yield the entities (with their operations) for the batchUpsert API one row at a time, without pandas.
+
+    Produces the same entities as create_upsert_entities while holding only the current row in memory.
+    """
+
+    with open(tsv, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        columns = next(reader)
+        entity_type = get_entity_type(columns[0])
+        if entity_type is None:
+            raise ValueError(f"Invalid load tsv: {tsv}")
+
+        # the first column's values are also uploaded as an attribute named after the table, like the pandas path
+        columns[0] = entity_type
+        array_attr_cols = list(array_attr_cols or [])
+        array_positions = [(col, columns.index(col)) for col in array_attr_cols]
+        single_positions = [(col, position) for position, col in enumerate(columns) if col not in set(array_attr_cols)]
+
+        for row in reader:
+            if not row:
+                continue
+
+            operations = []
+            for col, position in array_positions:
+                value = row[position] if position < len(row) else ""
+                if value:
+                    operations.append(create_list_attr_operation(col))
+                    operations.extend(add_list_member_operation(col, val) for val in convert_string_to_list(value))
+            for col, position in single_positions:
+                value = row[position] if position < len(row) else ""
+                if value:
+                    operations.append(create_non_array_attr_operation(col, value))
+
+            yield create_single_entity_request(row[0], entity_type, operations)
+
+
+def create_upsert_entities(tsv, array_attr_cols=None):
+    """Generate the entities (with their operations) for the batchUpsert API."""
+
+    # pandas is slow to import, so only pay for it on this path
+    import pandas
+
+    # Keep every value as the text in the file, and read empty cells as missing so they aren't uploaded as "nan"
+    tsv = pandas.read_csv(tsv, sep='\t', dtype=str, keep_default_na=False, na_values=[""])
+    entity_type_col_name = tsv.columns[0]
+    entity_type = get_entity_type(entity_type_col_name)
+    if entity_type is None:
         return
 
     # replace the "entity:col_name_id" with just "col_name" in df
-    # if not replaced, "attributeName" in the template_make_single_attr becomes "entity:entity_name_id" instead of just entity_name
+    # if not replaced, "attributeName" in the operations becomes "entity:entity_name_id" instead of just entity_name
     # when the API request is made, its read as multiple columns with the "entity" prefix which is illegal
     # this is specific just to the first column where the format is required for terra load tsv files
     tsv.rename(columns={entity_type_col_name: entity_type}, inplace=True)
 
-    # for every row (entity) in df
-    for index, row in tsv.iterrows():
-        # initialize string to capture request for one row (entity) in tsv
-        single_entity_operations = ''''''
-        # get the entity_id (row id - must be unique)
-        entity_id = str(row[0])
-
-        # if array columns/attributes provided
-        if array_attr_cols:
-            # for each array column
-            for col in array_attr_cols:
-                # get operation json to make the array/list attribute with column name
-                single_entity_operations += create_list_attr_operation(col)
-                # convert string value -> back into an array: [foo,bar] (str) --> ['foo', 'bar'] (list)
-                attr_values = convert_string_to_list(row[col])
-                # for each item in array (values pertaining to the list attribute as defined above)
-                for val in attr_values:
-                    # get operation json to add each array/list attribute's values to the request
-                    single_entity_operations += add_list_member_operation(col, val)
-
-            # get non-array/list attributes based on which of the full tsv columns are array attributes
-            single_attr_cols = list(set(list(tsv.columns)) - set(array_attr_cols))
-        # if no array columns/attributes provided
+    array_attr_cols = list(array_attr_cols or [])
+    # non-array/list attributes are the rest of the columns, in file order
+    single_attr_cols = [col for col in tsv.columns if col not in set(array_attr_cols)]
+
+    # Build the operations a column at a time, with missing cells as None instead of NaN
+    tsv = tsv.astype(object).where(tsv.notna(), None)
+    column_operations = [create_array_attr_operations(col, tsv[col].tolist()) for col in array_attr_cols]
+    column_operations += [create_non_array_attr_operations(col, tsv[col].tolist()) for col in single_attr_cols]
+
+    # then stitch each row's (entity's) operations back together
+    all_entities_request = [
+        create_single_entity_request(
+            entity_id, entity_type, [operation for operations in row_operations for operation in operations]
+        )
+        for entity_id, row_operations in zip(tsv.iloc[:, 0].tolist(), zip(*column_operations))
+    ]
+
+    return all_entities_request
+
+
+def attribute_value_matches(current_value, new_value):
+    """Return True if a value read back from rawls is the same as the tsv text we would upload."""
+
+    if isinstance(current_value, bool):
+        return str(current_value).lower() == new_value.lower()
+    if isinstance(current_value, (int, float)):
+        # Only compare as numbers if the tsv text is exactly how the number is written, so e.g. "007" still
+        # counts as a change to 7 rather than losing the leading zeros of an ID
+        for parse in (int, float):
+            try:
+                number = parse(new_value)
+            except ValueError:
+                continue
+            if str(number) == new_value:
+                return number == current_value
+        return str(current_value) == new_value
+    return current_value == new_value
+
+
+def group_operations(operations):
+    """Yield (attribute name, operations) with each list attribute's create and member operations kept together."""
+
+    group = []
+    for operation in operations:
+        if operation["op"] != "AddListMember" and group:
+            yield group[0].get("attributeName"), group
+            group = []
+        group.append(operation)
+    if group:
+        yield group[0].get("attributeName"), group
+
+
+def operations_change_attribute(operations, current_attributes):
+    """Return True if applying the operations of one attribute would change the entity's current value."""
+
+    name = operations[0]["attributeName"]
+    if name not in current_attributes:
+        return True
+    current_value = current_attributes[name]
+
+    if operations[0]["op"] == "CreateAttributeValueList":
+        # list attributes come back from rawls as {"itemsType": "AttributeValue", "items": [...]}
+        current_items = current_value.get("items") if isinstance(current_value, dict) else None
+        new_items = [operation["newMember"] for operation in operations[1:]]
+        return current_items is None or len(current_items) != len(new_items) or not all(
+            attribute_value_matches(current_item, new_item) for current_item, new_item in zip(current_items, new_items)
+        )
+
+    if operations[0]["op"] == "AddUpdateAttribute":
+        return not attribute_value_matches(current_value, operations[0]["addUpdateAttribute"])
+    return True
+
+
+def filter_changed_entities(entities, terra_service):
+    """Yield the entities with only the operations that change them, skipping entities with no changes at all.
+
+    The current values come from one download of each table (cached while the workspace is unchanged),
+    rather than a request per entity.
+    """
+
+    current_tables = {}
+    total = unchanged = 0
+    for entity in entities:
+        total += 1
+        entity_type = entity["entityType"]
+        if entity_type not in current_tables:
+            snapshot = terra_service.get_table_snapshot(entity_type)
+            current_tables[entity_type] = {e["name"]: e.get("attributes", {}) for e in snapshot.entities}
+
+        current_attributes = current_tables[entity_type].get(entity["name"])
+        if current_attributes is None:
+            # new entity, so everything is a change
+            yield entity
+            continue
+
+        operations = [
+            operation
+            for _, attribute_operations in group_operations(entity["operations"])
+            if operations_change_attribute(attribute_operations, current_attributes)
+            for operation in attribute_operations
+        ]
+        if operations:
+            yield create_single_entity_request(entity["name"], entity_type, operations)
         else:
-            single_attr_cols = list(tsv.columns)
-
-        # if there are non-array/list attribute columns - cases where all columns are arrays, single_attr_cols would be empty
-        if single_attr_cols:
-            # for each column that is not an array
-            for col in single_attr_cols:
-                # get value in col from df
-                attr_value = str(row[col])
-                # get operation json with the row (entity) value to the non-array column (attribute)
-                single_entity_operations += create_non_array_attr_operation(col, attr_value)
+            unchanged += 1
 
-        # remove trailing comma from the last request template
-        single_entity_operations = single_entity_operations[:-1]
+    print(f"{unchanged} of {total} entities are unchanged and will not be uploaded")
 
-        # fill in entity_type (table name), entity_name (row id), and all entity operations into request body template
-        single_entity_request = create_single_entity_request(entity_id, entity_type, single_entity_operations)
 
-        # add the request pertinent to the rows (entities) of a single workspace to list of all workspace requests
-        all_entities_request.append(single_entity_request)
+def create_upsert_request(tsv, array_attr_cols=None):
+    """Generate the request body for batchUpsert API."""
 
-    # remove quotes around elements of the list but keep the brackets - using sep() or join() get rid of the brackets
-    # ['{entity1}', '{entity2}', '{..}'] (api fails) --> [{entity1}, {entity2}, {..}] (api succeeds)
-    all_entities_request_formatted = '[%s]' % ','.join(all_entities_request)
+    all_entities_request = create_upsert_entities(tsv, array_attr_cols)
+    if all_entities_request is None:
+        return
 
-    return all_entities_request_formatted
+    # orjson escapes quotes, backslashes and control characters in values, which string concatenation did not
+    return orjson.dumps(all_entities_request).decode()
 
 
 if __name__ == '__main__':
@@ -158,9 +409,28 @@ if __name__ == '__main__':
     parser.add_argument('-w', '--workspace_name', required=True, help='name of workspace in which to make changes')
     parser.add_argument('-p', '--project', required=True, help='billing project (namespace) of workspace in which to make changes')
     parser.add_argument('-t', '--tsv', required=True, help='.tsv file formatted in load format to Terra UI')
+    parser.add_argument('-r', '--resume_file', required=False, help='file recording uploaded chunks, so a rerun only sends the rest')
+    parser.add_argument('--max_workers', type=int, default=MAX_UPLOAD_WORKERS, help='number of chunks to upload at the same time')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_MAX_ENTITIES, help='maximum number of entities per request')
+    parser.add_argument('--streaming', action='store_true', help='read the tsv row by row instead of loading it with pandas')
+    parser.add_argument('--gzip', action='store_true', help='gzip each request body')
+    parser.add_argument('--only_changed', action='store_true', help='only upload attributes that differ from the workspace')
 
     args = parser.parse_args()
-    # create request body for batchUpsert
-    request = create_upsert_request(args.tsv)
+    # create the entities for batchUpsert
+    if args.streaming:
+        # an invalid header raises before the first chunk is built, so nothing is uploaded
+        entities = iter_upsert_entities(args.tsv)
+    else:
+        entities = create_upsert_entities(args.tsv)
+        if entities is None:
+            sys.exit(1)
+    if args.only_changed:
+        entities = filter_changed_entities(entities, TerraAPIWrapper(args.project, args.workspace_name))
     # call batchUpsert API (rawls)
-    call_rawls_batch_upsert(args.workspace_name, args.project, request)
\ No newline at end of file
+    failed = call_rawls_batch_upsert(
+        args.workspace_name, args.project, entities,
+        resume_file=args.resume_file, max_workers=args.max_workers, max_entities=args.chunk_size, compress=args.gzip
+    )
+    if failed:
+        sys.exit(1)
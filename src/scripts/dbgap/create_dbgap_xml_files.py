@@ -18,9 +18,10 @@ def run_xml_creation(
         aggregation_version,
         phs_id,
         data_type,
+        terra_service=None,
 ):
 
-    terra_service = TerraAPIWrapper(billing_project, workspace_name)
+    terra_service = terra_service or TerraAPIWrapper(billing_project, workspace_name)
     sample_json = terra_service.call_terra_api(sample_id, "sample")
 
     # If this is a dragen sample, some fields may be missing from the metadata, in which case we add them
@@ -1,11 +1,12 @@
 import requests
 import json
-import re
 import os
+import sys
 import xmltodict
 from lxml import etree
 from datetime import datetime
 from src.services.dbgap_telemetry_report import DbgapTelemetryWrapper
+from src.services.read_structure import get_read_length, parse_read_structure
 
 
 BROAD_ABBREVIATION = "BI"
@@ -87,6 +88,30 @@ class Sample:
         return self.dbgap_info["repository"]
 
 
+class ReadGroupRecord:
+    """The per-read-group fields that ReadGroup aggregates. Values are interned, since the same run barcodes,
+    flowcells and library names repeat across the read groups of a sample."""
+
+    __slots__ = (
+        "run_barcode",
+        "lane",
+        "molecular_barcode_name",
+        "molecular_barcode_sequence",
+        "library_name",
+        "run_name",
+        "machine_name",
+        "flowcell_barcode",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, sys.intern(str(fields[name])))
+
+    @classmethod
+    def from_attributes(cls, attributes):
+        return cls(**{name: attributes[name] for name in cls.__slots__})
+
+
 class ReadGroup:
     def __init__(self, json_objects):
         first_read_group = json_objects[0]
@@ -147,33 +172,39 @@ class ReadGroup:
             return None
 
     def _set_aggregate_values(self, json_objects):
-        # Extract relevant attributes using list comprehension
-        attributes_list = [x for x in json_objects]
-
-        # Define helper functions for constructing aggregate values
-        def construct_read_group_id(row):
-            return f"{row['run_barcode'][:5]}.{row['lane']}"
-
-        def construct_molecular_idx(row):
-            return f"{row['molecular_barcode_name']} [{row['molecular_barcode_sequence']}]"
-
-        def construct_rg_platform(row):
-            return f"{row['run_barcode']}.{row['lane']}.{row['molecular_barcode_sequence']}"
-
-        def construct_rg_platform_lib(row):
-            return f"{construct_rg_platform(row)}.{row['library_name']}"
-
-        # Set comprehensions to generate aggregate values
-        self.read_group_ids = {construct_read_group_id(x) for x in attributes_list}
-        self.molecular_idx_schemes = {construct_molecular_idx(x) for x in attributes_list}
-        self.rg_platform_unit = {construct_rg_platform(x) for x in attributes_list}
-        self.rg_platform_unit_lib = {construct_rg_platform_lib(x) for x in attributes_list}
-
-        # Use set comprehension to extract unique values
-        self.run_barcode = {x['run_barcode'] for x in attributes_list}
-        self.run_name = {x['run_name'] for x in attributes_list}
-        self.instrument_names = {x['machine_name'] for x in attributes_list}
-        self.flowcell_barcodes = {x['flowcell_barcode'] for x in attributes_list}
+        # Keep only the fields the aggregates need, as compact records of interned strings
+        self.records = tuple(ReadGroupRecord.from_attributes(x) for x in json_objects)
+
+        read_group_ids = set()
+        molecular_idx_schemes = set()
+        rg_platform_unit = set()
+        rg_platform_unit_lib = set()
+        run_barcode = set()
+        run_name = set()
+        instrument_names = set()
+        flowcell_barcodes = set()
+
+        # Build every aggregate in a single pass over the read groups
+        for record in self.records:
+            platform_unit = f"{record.run_barcode}.{record.lane}.{record.molecular_barcode_sequence}"
+            read_group_ids.add(f"{record.run_barcode[:5]}.{record.lane}")
+            molecular_idx_schemes.add(f"{record.molecular_barcode_name} [{record.molecular_barcode_sequence}]")
+            rg_platform_unit.add(platform_unit)
+            rg_platform_unit_lib.add(f"{platform_unit}.{record.library_name}")
+            run_barcode.add(record.run_barcode)
+            run_name.add(record.run_name)
+            instrument_names.add(record.machine_name)
+            flowcell_barcodes.add(record.flowcell_barcode)
+
+        # Sorted, so the Run submitter_id and attributes are the same on every run
+        self.read_group_ids = tuple(sorted(read_group_ids))
+        self.molecular_idx_schemes = tuple(sorted(molecular_idx_schemes))
+        self.rg_platform_unit = tuple(sorted(rg_platform_unit))
+        self.rg_platform_unit_lib = tuple(sorted(rg_platform_unit_lib))
+        self.run_barcode = tuple(sorted(run_barcode))
+        self.run_name = tuple(sorted(run_name))
+        self.instrument_names = tuple(sorted(instrument_names))
+        self.flowcell_barcodes = tuple(sorted(flowcell_barcodes))
 
     def pairing_code(self):
         return "P" if self.paired_run else "S"
@@ -221,9 +252,7 @@ class ReadGroup:
         raise ValueError(f"No library descriptor found for the given parameters - library type: {self.library_type}")
 
     def get_read_length(self):
-        reg_expr = re.search("[SBM](\d+)T", self.read_structure)
-
-        return int(reg_expr.group(1)) if reg_expr else 0
+        return get_read_length(self.read_structure)
 
 
 class Experiment:
@@ -260,10 +289,7 @@ class Experiment:
         }
 
     def get_spot_length(self):
-        return (
-            str(self.read_group.get_read_length() * 2)
-            if self.read_group.paired_run else str(self.read_group.get_read_length())
-        )
+        return str(parse_read_structure(self.read_group.read_structure).spot_length)
 
     def generate_experiment_attributes(self):
         attributes_dict = {
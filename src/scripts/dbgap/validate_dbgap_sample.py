@@ -1,26 +1,162 @@
 import argparse
-from src.services.dbgap_telemetry_report import DbgapTelemetryWrapper
+import csv
+import json
+from collections import defaultdict
+
+from src.services.dbgap_telemetry_report import DbgapTelemetryWrapper, TelemetryStatusSnapshot
 
 SAMPLE_STATUS_FILE_PATH = '/cromwell_root/sample_status.tsv'
+SAMPLE_STATUS_HEADER = "entity:sample_id\tsample_status\n"
+WRITTEN_STATUSES_FILE_PATH = '/cromwell_root/written_statuses.json'
 
 
 def save_sample_status(sample_id, state_info):
     """Saves the file state information to a file."""
     with open(SAMPLE_STATUS_FILE_PATH, 'w') as file:
         # Write header
-        file.write("entity:sample_id\tsample_status\n")
+        file.write(SAMPLE_STATUS_HEADER)
         # Write data
         file.write(f"{sample_id}\t{state_info}")
 
 
+def save_sample_statuses(sample_statuses):
+    """Saves one row per sample to a load file that can be passed straight to batch_upsert_entities.py"""
+    with open(SAMPLE_STATUS_FILE_PATH, 'w') as file:
+        file.write(SAMPLE_STATUS_HEADER)
+        for sample_id, state_info in sample_statuses.items():
+            file.write(f"{sample_id}\t{state_info}\n")
+
+
+def load_samples(samples_file, default_phs_id=None, default_data_type=None):
+    """Reads the cohort from a TSV with a header row, or a JSON list of objects, with the columns
+    sample_id, sample_alias, phs_id and data_type. phs_id and data_type fall back to the command line values."""
+    with open(samples_file, 'r') as file:
+        if samples_file.endswith(".json"):
+            rows = json.load(file)
+        else:
+            rows = list(csv.DictReader(file, delimiter="\t"))
+
+    samples = []
+    for row in rows:
+        sample = {
+            "sample_id": row["sample_id"],
+            "sample_alias": row["sample_alias"],
+            "phs_id": row.get("phs_id") or default_phs_id,
+            "data_type": row.get("data_type") or default_data_type,
+        }
+        if not sample["phs_id"] or not sample["data_type"]:
+            raise ValueError(f"Sample '{sample['sample_id']}' is missing a phs_id or data_type")
+        samples.append(sample)
+
+    return samples
+
+
+def save_written_statuses(written_statuses, path=WRITTEN_STATUSES_FILE_PATH):
+    """Saves the statuses about to be written to Terra, so they can be recorded in the snapshot once they have been"""
+    with open(path, 'w') as file:
+        json.dump(
+            {
+                phs_id: [[alias, data_type, status] for (alias, data_type), status in statuses.items()]
+                for phs_id, statuses in written_statuses.items()
+            },
+            file
+        )
+
+
+def record_written_statuses(snapshot, path=WRITTEN_STATUSES_FILE_PATH):
+    """Records the statuses saved by save_written_statuses in the snapshot. Only call this once the load file
+    has been upserted, or the next run would skip statuses that never reached the sample table."""
+    with open(path, 'r') as file:
+        written_statuses = json.load(file)
+
+    for phs_id, statuses in written_statuses.items():
+        snapshot.record(phs_id, {(alias, data_type): status for alias, data_type, status in statuses})
+    return sum(len(statuses) for statuses in written_statuses.values())
+
+
+def get_cohort_statuses(samples, snapshot=None, changes_only=False):
+    """Looks up the status of every sample, downloading each study's telemetry report only once. With a snapshot,
+    changes_only limits the result to samples whose status differs from what was last written.
+
+    Returns:
+        tuple: {sample_id: status} to write, and {phs_id: {(alias, data_type): status}} of the same statuses
+        for the snapshot. The snapshot itself is left untouched until they have been written.
+    """
+    samples_by_study = defaultdict(list)
+    for sample in samples:
+        samples_by_study[sample["phs_id"]].append(sample)
+
+    sample_statuses = {}
+    written_statuses = defaultdict(dict)
+    for phs_id, study_samples in samples_by_study.items():
+        telemetry = DbgapTelemetryWrapper(phs_id=phs_id)
+
+        samples_by_data_type = defaultdict(list)
+        for sample in study_samples:
+            samples_by_data_type[sample["data_type"]].append(sample)
+
+        for data_type, data_type_samples in samples_by_data_type.items():
+            aliases = [s["sample_alias"] for s in data_type_samples]
+            statuses = telemetry.get_sample_statuses(aliases, data_type)
+            if changes_only:
+                changed_statuses = telemetry.get_changed_sample_statuses(aliases, data_type, snapshot)
+
+            for sample in data_type_samples:
+                alias = sample["sample_alias"]
+                if alias not in statuses:
+                    print(f"WARNING: Sample with alias '{alias}' not found in {phs_id}")
+                elif not changes_only or alias in changed_statuses:
+                    sample_statuses[sample["sample_id"]] = statuses[alias]
+                    written_statuses[phs_id][(alias, data_type)] = statuses[alias]
+
+    return sample_statuses, dict(written_statuses)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Check the current status of sample in Dbgap by parsing the Telemetry report.')
-    parser.add_argument('-sample_alias', required=True, help='Sample alias to use when querying DbGap')
-    parser.add_argument('-sample_id', required=True, help='Sample id to allow us to write back to the data table')
-    parser.add_argument('-phs_id', required=True, help='phs_id sample is linked to')
-    parser.add_argument('-data_type', required=True, help='Data type to use when querying DbGap')
+    parser.add_argument('-sample_alias', required=False, help='Sample alias to use when querying DbGap')
+    parser.add_argument('-sample_id', required=False, help='Sample id to allow us to write back to the data table')
+    parser.add_argument('-phs_id', required=False, help='phs_id sample is linked to')
+    parser.add_argument('-data_type', required=False, help='Data type to use when querying DbGap')
+    parser.add_argument(
+        '-samples_file',
+        required=False,
+        help='TSV or JSON list of samples (sample_id, sample_alias, phs_id, data_type) to check in a single run'
+    )
+    parser.add_argument('-snapshot_db', required=False, help='SQLite file with the statuses seen on the previous run')
+    parser.add_argument(
+        '-record_written',
+        required=False,
+        help='Record the statuses a -samples_file run saved to this file in -snapshot_db, once they have been upserted'
+    )
+    parser.add_argument(
+        '-changes_only',
+        action='store_true',
+        help='Only write samples whose status changed since -snapshot_db was last updated'
+    )
     args = parser.parse_args()
 
-    sample_status = DbgapTelemetryWrapper(phs_id=args.phs_id).get_sample_status(args.sample_alias, args.data_type)
-    save_sample_status(sample_id=args.sample_id, state_info=sample_status)
-    print(f"Script finished with sample status of - {sample_status}")
+    if args.record_written:
+        if not args.snapshot_db:
+            parser.error("-record_written requires -snapshot_db")
+        recorded = record_written_statuses(TelemetryStatusSnapshot(args.snapshot_db), args.record_written)
+        print(f"Script finished, recorded {recorded} written statuses in the snapshot")
+    elif args.samples_file:
+        cohort = load_samples(args.samples_file, default_phs_id=args.phs_id, default_data_type=args.data_type)
+        if args.changes_only and not args.snapshot_db:
+            parser.error("-changes_only requires -snapshot_db")
+
+        status_snapshot = TelemetryStatusSnapshot(args.snapshot_db) if args.snapshot_db else None
+        cohort_statuses, written_statuses = get_cohort_statuses(
+            cohort, snapshot=status_snapshot, changes_only=args.changes_only
+        )
+        save_sample_statuses(cohort_statuses)
+        save_written_statuses(written_statuses)
+        print(f"Script finished, writing the status of {len(cohort_statuses)} of {len(cohort)} samples")
+    else:
+        if not all([args.sample_alias, args.sample_id, args.phs_id, args.data_type]):
+            parser.error("-sample_alias, -sample_id, -phs_id and -data_type are required without -samples_file")
+
+        sample_status = DbgapTelemetryWrapper(phs_id=args.phs_id).get_sample_status(args.sample_alias, args.data_type)
+        save_sample_status(sample_id=args.sample_id, state_info=sample_status)
+        print(f"Script finished with sample status of - {sample_status}")
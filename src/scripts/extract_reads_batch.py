@@ -0,0 +1,104 @@
+import argparse
+import csv
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from src.scripts.extract_reads_metadata_from_json import (
+    extract_reads_data_from_json_dbgap,
+    extract_reads_data_from_json_gdc,
+    extract_reads_data_from_workspace_metadata,
+)
+from src.services.terra import TerraAPIWrapper
+
+READS_NDJSON_PATH = "/cromwell_root/reads.ndjson"
+MAX_EXTRACT_WORKERS = 16  # downloads are network-bound, so this can be well above the core count
+
+
+def load_manifest(manifest_file):
+    """Reads the samples from a TSV with a header row, or a JSON list of objects, with the columns
+    sample_alias and json_path. Samples without a json_path are looked up in the workspace instead."""
+    with open(manifest_file, "r") as file:
+        if manifest_file.endswith(".json"):
+            rows = json.load(file)
+        else:
+            rows = list(csv.DictReader(file, delimiter="\t"))
+
+    return [{"sample_alias": row["sample_alias"], "json_path": row.get("json_path") or None} for row in rows]
+
+
+def extract_sample_reads(sample, is_gdc, terra_service=None):
+    """Returns the output record of one sample - its reads, or the error that stopped us getting them"""
+    try:
+        if not sample["json_path"]:
+            if terra_service is None:
+                raise ValueError("The sample has no json_path and no workspace was given to look it up in")
+            reads = extract_reads_data_from_workspace_metadata(
+                sample["sample_alias"], None, None, is_gdc, terra_service=terra_service, output_path=None
+            )
+        elif is_gdc:
+            reads = extract_reads_data_from_json_gdc(sample["sample_alias"], sample["json_path"], output_path=None)
+        else:
+            reads = extract_reads_data_from_json_dbgap(sample["json_path"], output_path=None)
+    except Exception as e:
+        return {"sample_alias": sample["sample_alias"], "error": f"{type(e).__name__}: {e}"}
+    return {"sample_alias": sample["sample_alias"], "reads": reads}
+
+
+def extract_reads_batch(samples, is_gdc, output_path=READS_NDJSON_PATH, max_workers=MAX_EXTRACT_WORKERS,
+                        terra_service=None):
+    """
+    Extracts the reads of every sample on a thread pool and writes them to one NDJSON file, a line per sample
+    in manifest order. Samples without a json_path are looked up through terra_service, which should be created
+    with use_snapshots=True so the read-group table is downloaded once rather than queried once per sample.
+
+    Returns:
+        dict: {sample_alias: error} for the samples that failed.
+    """
+    failures = {}
+    if terra_service is not None and terra_service.use_snapshots and any(not sample["json_path"] for sample in samples):
+        # Load the snapshot before the workers start, so they don't all download it at once
+        terra_service.get_table_snapshot("read-group")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, open(output_path, "w") as output:
+        # map hands the records back in manifest order, so each line can be written as soon as it's ready
+        for record in executor.map(lambda sample: extract_sample_reads(sample, is_gdc, terra_service), samples):
+            output.write(json.dumps(record) + "\n")
+            if "error" in record:
+                failures[record["sample_alias"]] = record["error"]
+                print(f"ERROR: Could not extract reads for {record['sample_alias']}: {record['error']}")
+            else:
+                print(f"Extracted {len(record['reads'])} reads for {record['sample_alias']}")
+
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the read group metadata of many samples into one NDJSON file")
+    parser.add_argument("-m", "--manifest", required=True, help="TSV or JSON list of samples with sample_alias and json_path")
+    parser.add_argument("-w", "--workspace_name", required=False, help="workspace to look up the samples without a json_path in")
+    parser.add_argument("-b", "--billing_project", required=False, help="billing project (namespace) of the workspace")
+    parser.add_argument("-d", "--destination", required=True, choices=["gdc", "dbgap"], help="format to extract the reads in")
+    parser.add_argument("-o", "--output_path", default=READS_NDJSON_PATH, help="NDJSON file to write, one line per sample")
+    parser.add_argument("--max_workers", type=int, default=MAX_EXTRACT_WORKERS, help="number of samples to extract at the same time")
+    parser.add_argument("--allow_failures", action="store_true", help="exit successfully even if some samples failed")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest)
+    terra = None
+    if args.workspace_name and args.billing_project:
+        # Every sample is looked up in the same read-group table, so download it once instead of querying per sample
+        terra = TerraAPIWrapper(args.billing_project, args.workspace_name, use_snapshots=True)
+    elif any(not sample["json_path"] for sample in manifest):
+        parser.error("--workspace_name and --billing_project are required when some samples have no json_path")
+
+    failed_samples = extract_reads_batch(
+        manifest,
+        is_gdc=args.destination == "gdc",
+        output_path=args.output_path,
+        max_workers=args.max_workers,
+        terra_service=terra,
+    )
+    print(f"Extracted reads for {len(manifest) - len(failed_samples)} of {len(manifest)} samples")
+    if failed_samples and not args.allow_failures:
+        sys.exit(1)
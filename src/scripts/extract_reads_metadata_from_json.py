@@ -1,8 +1,10 @@
 import json
-import re
-from google.cloud import storage
 from urllib.parse import urlparse
 
+import ijson
+
+from src.services.gcs import get_content_cache
+from src.services.read_structure import get_read_length
 from src.services.terra import TerraAPIWrapper
 
 READS_JSON_PATH = "/cromwell_root/reads.json"
@@ -16,27 +18,42 @@ GDC_TWIST_CAPTURE_KIT = "Custom Twist Broad Exome v1.0 - 35.0 Mb"
 MERCURY_TWIST_CAPTURE_KIT = "Kit,xGen Hybridization + Wash(96Rxn/BX)"
 GDC_NEXTERA_CAPTURE_KIT = "Nextera Rapid Capture Exome v1.2"
 ILLUMINA_PLATFORM = "Illumina"
-
-
-def get_json_contents(read_group_metadata_json):
-    """Gets the JSON contents from the given path. Different logic is used depending
+# The read-group attributes the dbGaP ReadGroup class reads, so the rest of the (wide) table isn't downloaded
+DBGAP_READ_GROUP_ATTRIBUTES = [
+    "library_name",
+    "library_type",
+    "work_request_id",
+    "analysis_type",
+    "paired_run",
+    "read_structure",
+    "sample_lsid",
+    "reference_sequence",
+    "model",
+    "research_project_id",
+    "bait_set",
+    "sample_barcode",
+    "product_order_id",
+    "sample_material_type",
+    "submission_metadata",
+    "run_barcode",
+    "lane",
+    "run_name",
+    "molecular_barcode_name",
+    "molecular_barcode_sequence",
+    "machine_name",
+    "flowcell_barcode",
+]
+
+
+def get_json_location(read_group_metadata_json):
+    """Returns the (bucket name, file path) of the JSON file. Different logic is used depending
     on whether the JSON file is in an external GCP bucket, or in the bucket of the workspace where
     the submission is running."""
 
-    client = storage.Client()
-
-    print("Reading JSON file from GCP bucket")
     # If the JSON file is in an external GCP bucket, then the path will start with "gs://"
     if read_group_metadata_json.startswith("gs://"):
         parsed_url = urlparse(read_group_metadata_json)
-        bucket_name = parsed_url.netloc
-        file_path = parsed_url.path.lstrip("/")
-
-        bucket = client.get_bucket(bucket_name)
-        blob = bucket.blob(file_path)
-        content = blob.download_as_string()
-        json_data = json.loads(content)
-        return json_data
+        return parsed_url.netloc, parsed_url.path.lstrip("/")
     # If the JSON file is in the workspace bucket, then the path will start with "/mnt/disks/cromwell_root/"
     elif read_group_metadata_json.startswith("/mnt/disks/cromwell_root/"):
         path_parts = read_group_metadata_json.strip("/").split("/")
@@ -46,17 +63,31 @@ def get_json_contents(read_group_metadata_json):
 
         if not bucket_name.startswith("fc-"):
             raise ValueError(f"Bucket name must start with 'fc-', instead got: '{bucket_name}'")
+        return bucket_name, file_path
+    else:
+        raise ValueError(f"Invalid path for JSON file: {read_group_metadata_json}. Must start with 'gs://' or '/mnt/disks/cromwell_root/'")
+
 
-        blob = client.bucket(bucket_name).get_blob(file_path)
-        if blob is None:
-            raise FileNotFoundError(f"Blob not found: gs://{bucket_name}/{file_path}")
+def get_json_contents(read_group_metadata_json):
+    """Gets the JSON contents from the given path. The same object generation is only downloaded once per machine."""
 
-        content = blob.download_as_string()
-        json_data = json.loads(content)
+    print("Reading JSON file from GCP bucket")
+    bucket_name, file_path = get_json_location(read_group_metadata_json)
+    json_data = get_content_cache().get_json(bucket_name, file_path)
+    if read_group_metadata_json.startswith("/mnt/disks/cromwell_root/"):
         print(f"Extracted JSON metadata:\n{json_data}")
-        return json_data
-    else:
-        raise ValueError(f"Invalid path for JSON file: {read_group_metadata_json}. Must start with 'gs://' or '/mnt/disks/cromwell_root/'")
+    return json_data
+
+
+def iter_json_runs(read_group_metadata_json):
+    """Yields the entries of the JSON file's "runs" array one at a time, parsing the file as it is streamed from
+    the bucket, so only the current run is held in memory"""
+
+    print("Streaming JSON file from GCP bucket")
+    bucket_name, file_path = get_json_location(read_group_metadata_json)
+    with get_content_cache().open_stream(bucket_name, file_path) as stream:
+        # use_float so numbers come back as int/float like json.loads gives, not Decimal
+        yield from ijson.items(stream, "runs.item", use_float=True)
 
 def determine_target_capture_kit(data_type, submissions_metadata):
     if submissions_metadata:
@@ -73,37 +104,30 @@ def determine_target_capture_kit(data_type, submissions_metadata):
             return "Not Applicable"
     return "Not Applicable"
 
-def extract_reads_data_from_workspace_metadata(sample_alias, billing_project, workspace_name, is_gdc):
-    """Grab the reads data for the given sample_id"""
-    reads_data = TerraAPIWrapper(billing_project, workspace_name).call_terra_api(sample_alias, "read-group")
-    formatted_reads = [read["attributes"] for read in reads_data]
+def extract_reads_data_from_workspace_metadata(sample_alias, billing_project, workspace_name, is_gdc, terra_service=None,
+                                               output_path=READS_JSON_PATH):
+    """Grab the reads data for the given sample_id. Pass a terra_service created with use_snapshots=True
+    to look up many samples from a single download of the read-group table."""
+    terra_service = terra_service or TerraAPIWrapper(billing_project, workspace_name)
 
     if is_gdc:
-        reads = reads_data
+        # GDC needs every library_preparation* attribute, which can't be listed up front
+        reads = terra_service.call_terra_api(sample_alias, "read-group")
     else:
-        reads = formatted_reads
+        reads = [
+            read["attributes"]
+            for read in terra_service.call_terra_api(sample_alias, "read-group", attributes=DBGAP_READ_GROUP_ATTRIBUTES)
+        ]
 
-    with open(READS_JSON_PATH, "w") as f:
-        f.write(json.dumps(reads))
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(json.dumps(reads))
 
     return reads
 
 def get_read_length_from_read_structure(read_structure):
-    # Grab the first "section" before the T in the read structure. This can either be an integer, or a mix of
-    # letters and integers if it's a UMI-aware read structure
-    first_read = read_structure.split("T")[0]
-
-    try:
-        # If the read structure looks something like 76T8B8B76T, we get the read length by looking at the integer
-        # before the first "T" - in this case "76" and we can automatically determine by trying to convert to an int
-        int(first_read)
-        return int(first_read)
-    except ValueError:
-        # If the read structure looks something like 3M2S71T8B8B3M2S71T, the read length is the sum of the numbers
-        # before the first "T" - so 3 + 2 + 71 in this example, and we need to add them manually
-        integers = re.findall(pattern=r"\d+", string=first_read)
-        total = sum(int(num) for num in integers)
-        return int(total)
+    # The same read length the dbGaP XML reports, so the two submissions agree
+    return get_read_length(read_structure)
 
 
 def extract_molecular_barcode_name_and_sequence(molecular_indexing_scheme):
@@ -121,47 +145,65 @@ def determine_library_selection(product_type):
     else:
         return "Random"
 
-def extract_reads_data_from_json_gdc(sample_alias, read_group_metadata_json_path):
-    """Grab the reads data for the given sample_id"""
-    sample_metadata = get_json_contents(read_group_metadata_json_path)
-
-    read_group_metadata = []
-    for run in sample_metadata["runs"]:
-        lanes = run["lanes"]
+def iter_reads_data_from_runs_gdc(sample_alias, runs):
+    """Yields the GDC read group record of every library in every lane of the given runs"""
+    for run in runs:
+        # the same for every read group in the run
+        read_length = get_read_length_from_read_structure(run["setupReadStructure"])
 
-        for lane in lanes:
-            libraries = lane["libraries"]
-            for library in libraries:
+        for lane in run["lanes"]:
+            for library in lane["libraries"]:
                 data_type_converted = DATA_TYPE_CONVERSION[library["dataType"]]
                 agg_project = library["researchProjectId"]
-                read_group_metadata.append(
-                    {
-                        "attributes": {
-                            "aggregation_project": agg_project,
-                            "sample_identifier": sample_alias,
-                            "flow_cell_barcode": run["flowcellBarcode"],
-                            "experiment_name": f"{sample_alias}.{data_type_converted}.{agg_project}",
-                            "sequencing_center": BROAD_SEQUENCING_CENTER_ABBREVIATION,
-                            "platform": ILLUMINA_PLATFORM,
-                            "library_selection": determine_library_selection(library["productFamily"]),
-                            "data_type": data_type_converted,
-                            "library_name": library["library"],
-                            "lane_number": int(lane["name"]),
-                            "is_paired_end": run["pairedRun"],
-                            "read_length": get_read_length_from_read_structure(run["setupReadStructure"]),
-                            "target_capture_kit": determine_target_capture_kit(
-                                data_type=library["dataType"], submissions_metadata=library.get("submissionMetadata")
-                            ),
-                        }
+                yield {
+                    "attributes": {
+                        "aggregation_project": agg_project,
+                        "sample_identifier": sample_alias,
+                        "flow_cell_barcode": run["flowcellBarcode"],
+                        "experiment_name": f"{sample_alias}.{data_type_converted}.{agg_project}",
+                        "sequencing_center": BROAD_SEQUENCING_CENTER_ABBREVIATION,
+                        "platform": ILLUMINA_PLATFORM,
+                        "library_selection": determine_library_selection(library["productFamily"]),
+                        "data_type": data_type_converted,
+                        "library_name": library["library"],
+                        "lane_number": int(lane["name"]),
+                        "is_paired_end": run["pairedRun"],
+                        "read_length": read_length,
+                        "target_capture_kit": determine_target_capture_kit(
+                            data_type=library["dataType"], submissions_metadata=library.get("submissionMetadata")
+                        ),
                     }
-                )
+                }
 
-    with open(READS_JSON_PATH, "w") as f:
-        f.write(json.dumps(read_group_metadata))
 
-    return read_group_metadata
+def iter_reads_data_from_json_gdc(sample_alias, read_group_metadata_json_path):
+    """Yields the reads data for the given sample_id while the JSON file is streamed, one run at a time"""
+    yield from iter_reads_data_from_runs_gdc(sample_alias, iter_json_runs(read_group_metadata_json_path))
 
-def extract_reads_data_from_json_dbgap(read_group_metadata_json_path: str):
+
+def write_reads_json_as_read(read_groups, output_path=READS_JSON_PATH):
+    """Yields each read group after writing it to output_path as the next element of a JSON array, so the file
+    is written as the read groups are consumed rather than after all of them have been collected. The array is
+    closed once the read groups run out."""
+    with open(output_path, "w") as f:
+        f.write("[")
+        for position, read_group in enumerate(read_groups):
+            if position:
+                f.write(", ")
+            f.write(json.dumps(read_group))
+            yield read_group
+        f.write("]")
+
+
+def extract_reads_data_from_json_gdc(sample_alias, read_group_metadata_json_path, output_path=READS_JSON_PATH):
+    """Grab the reads data for the given sample_id. Pass output_path=None to skip writing them to a file.
+    The JSON file is parsed as it streams in, and each read group is written to output_path as soon as it is built."""
+    read_groups = iter_reads_data_from_json_gdc(sample_alias, read_group_metadata_json_path)
+    if output_path:
+        read_groups = write_reads_json_as_read(read_groups, output_path)
+    return list(read_groups)
+
+def extract_reads_data_from_json_dbgap(read_group_metadata_json_path: str, output_path: str = None):
     sample_metadata = get_json_contents(read_group_metadata_json_path)
 
     read_group_metadata_json = []
@@ -197,4 +239,9 @@ def extract_reads_data_from_json_dbgap(read_group_metadata_json_path: str):
                 }
             }
         )
+
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(json.dumps(read_group_metadata_json))
+
     return read_group_metadata_json
\ No newline at end of file
@@ -1,12 +1,15 @@
 import argparse
 import logging
+from collections import defaultdict
 
 from src.scripts.extract_reads_metadata_from_json import (
-    extract_reads_data_from_json_gdc,
+    iter_reads_data_from_json_gdc,
+    write_reads_json_as_read,
     extract_reads_data_from_workspace_metadata,
     DATA_TYPE_CONVERSION
 )
 from src.services.gdc_api import GdcApiWrapper
+from src.services.submission_ledger import SubmissionLedger
 
 
 logging.basicConfig(
@@ -38,6 +41,17 @@ def get_args():
         required=False,
         help="GCP path to the read group metadata JSON file"
     )
+    parser.add_argument(
+        "-l",
+        "--ledger",
+        required=False,
+        help="Submission ledger (SQLite) to skip read groups that were already committed, and to record new commits in"
+    )
+    parser.add_argument(
+        "--skip_local_validation",
+        action="store_true",
+        help="Don't check the reads against the GDC dictionary before submitting them, and leave that to GDC"
+    )
     return parser.parse_args()
 
 
@@ -84,26 +98,50 @@ def format_read_group(read):
     return {**formatted_read, **library_strand_dict}
 
 
-def submit_reads(read_metadata, token, project, program):
+def submit_reads(read_metadata, token, project, program, ledger=None, validate_locally=True):
     formatted_reads = [format_read_group(read["attributes"]) for read in read_metadata]
-    operation = GdcApiWrapper(
+    gdc_wrapper = GdcApiWrapper(
         program=program,
         project=project,
-        token=token
-    ).submit_metadata(formatted_reads)
+        token=token,
+        validate_locally=validate_locally
+    )
 
-    if operation == "close":
-        raise Exception(f"Failed to submit reads, operation: {operation}")
-    if operation == "commit":
-        logging.info(f"Successfully submitted reads, operation: {operation}")
+    if ledger:
+        formatted_reads = ledger.get_uncommitted(gdc_wrapper, formatted_reads, "read_group")
+        if not formatted_reads:
+            logging.info("All reads were already submitted")
+            return
+
+    # Each read group succeeds or fails on its own, so one bad record doesn't hold back the rest of the sample.
+    # The committed ones are recorded in the ledger, so a rerun only submits the ones that failed.
+    outcomes = gdc_wrapper.submit_entities(formatted_reads)
+
+    if ledger:
+        committed_by_transaction = defaultdict(list)
+        for read in formatted_reads:
+            outcome = outcomes.get(read["submitter_id"], {})
+            if outcome.get("status") == "committed":
+                committed_by_transaction[outcome["transaction_id"]].append(read)
+        for transaction_id, committed_reads in committed_by_transaction.items():
+            ledger.record_commit(program, project, committed_reads, transaction_id)
+
+    failed = {submitter_id: outcome for submitter_id, outcome in outcomes.items() if outcome["status"] == "failed"}
+    if failed:
+        raise Exception(f"Failed to submit reads: {failed}")
+    logging.info(f"Successfully submitted {len(outcomes)} reads")
 
 
 if __name__ == "__main__":
     args = get_args()
     if args.read_group_metadata_json:
-        reads = extract_reads_data_from_json_gdc(
-            sample_alias=args.sample_alias,
-            read_group_metadata_json_path=args.read_group_metadata_json,
+        # submit_reads formats each read group as it is parsed and written to reads.json, so the raw
+        # read groups are never all held at once
+        reads = write_reads_json_as_read(
+            iter_reads_data_from_json_gdc(
+                sample_alias=args.sample_alias,
+                read_group_metadata_json_path=args.read_group_metadata_json,
+            )
         )
     else:
         reads = extract_reads_data_from_workspace_metadata(
@@ -113,4 +151,12 @@ if __name__ == "__main__":
             is_gdc=True,
         )
 
-    submit_reads(reads, args.token, args.project, args.program)
+    submission_ledger = SubmissionLedger(args.ledger) if args.ledger else None
+    submit_reads(
+        reads,
+        args.token,
+        args.project,
+        args.program,
+        ledger=submission_ledger,
+        validate_locally=not args.skip_local_validation,
+    )
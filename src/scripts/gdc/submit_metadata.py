@@ -1,12 +1,13 @@
 import argparse
 import json
 import time
-import random
 import logging
-from google.cloud import storage
 from urllib.parse import urlparse
 
-from src.services.gdc_api import GdcApiWrapper
+from src.services.backoff import decorrelated_jitter
+from src.services.gcs import get_blob
+from src.services.gdc_api import GdcApiWrapper, GdcSubmissionError
+from src.services.submission_ledger import SubmissionLedger
 
 logging.basicConfig(
     format="%(levelname)s: %(asctime)s : %(message)s", level=logging.INFO
@@ -20,9 +21,15 @@ DATA_TYPE_TO_EXPERIMENT_STRATEGY = {
     "RNA": "RNA-Seq",
     "Custom_Selection": "Targeted Sequencing"
 }
+MAX_SUBMISSION_ATTEMPTS = 10
+RETRY_BASE_DELAY = 2  # in seconds
+RETRY_MAX_DELAY = 120  # in seconds
+READINESS_POLL_INITIAL_DELAY = 1  # in seconds
+READINESS_POLL_MAX_DELAY = 30  # in seconds
+READINESS_TIMEOUT = 600  # in seconds
 
 class MetadataSubmission:
-    def __init__(self, program=None, project=None, token=None, sample_alias=None, aggregation_path=None, agg_project=None, data_type=None, md5=None, read_groups=None):
+    def __init__(self, program=None, project=None, token=None, sample_alias=None, aggregation_path=None, agg_project=None, data_type=None, md5=None, read_groups=None, ledger=None, skip_local_validation=False):
         self.program = program
         self.project = project
         self.token = token
@@ -32,36 +39,69 @@ class MetadataSubmission:
         self.data_type = data_type
         self.md5 = md5
         self.read_groups = read_groups
+        self.ledger = SubmissionLedger(ledger) if ledger else None
+        self.validate_locally = not skip_local_validation
         self.submitter_id = f"{sample_alias}.{data_type}.{agg_project}"
 
     def submit(self):
         metadata = self.create_metadata()
-        gdc_wrapper = GdcApiWrapper(program=self.program, project=self.project, token=self.token)
-
-        sleep_time = random.randint(1, 100)
-        logging.info(f"Sleeping for {sleep_time} seconds before starting...")
-        time.sleep(sleep_time)
-        max_retries = 10
-        retry_delay = 60  # in seconds
-
-        for attempt in range(1, max_retries + 1):
-            logging.info(f"Attempt {attempt} of {max_retries}")
-            operation = gdc_wrapper.submit_metadata(metadata)
-            if operation == "commit":
-                break
-            else:
-                if attempt < max_retries:
-                    time.sleep(retry_delay)
-                else:
-                    logging.error("Max retries reached. Exiting...")
-                    raise Exception
+        gdc_wrapper = GdcApiWrapper(
+            program=self.program, project=self.project, token=self.token, validate_locally=self.validate_locally
+        )
+
+        if self.ledger and not self.ledger.get_uncommitted(gdc_wrapper, [metadata], "sar"):
+            logging.info(f"{self.submitter_id} was already committed with identical metadata, skipping submission")
+        else:
+            self.submit_with_retries(gdc_wrapper, metadata)
+            if self.ledger:
+                self.ledger.record_commit(self.program, self.project, [metadata], gdc_wrapper.last_transaction_id)
 
-        time.sleep(100) # Wait a bit since gdc can lag a little
         self.write_bam_data_to_file()
-        self.write_uuid_to_file(gdc_wrapper)
+        uuid = self.write_uuid_to_file(gdc_wrapper)
+        if self.ledger and uuid:
+            self.ledger.record_uuid(self.program, self.project, self.submitter_id, uuid)
+
+    @staticmethod
+    def submit_with_retries(gdc_wrapper, metadata):
+        retry_delays = decorrelated_jitter(base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY)
+
+        for attempt in range(1, MAX_SUBMISSION_ATTEMPTS + 1):
+            logging.info(f"Attempt {attempt} of {MAX_SUBMISSION_ATTEMPTS}")
+            try:
+                gdc_wrapper.submit_metadata(metadata)
+                return
+            except GdcSubmissionError as e:
+                # Only back off when another transaction or GDC itself got in the way - bad metadata won't fix itself
+                if not e.retryable:
+                    raise
+                if attempt == MAX_SUBMISSION_ATTEMPTS:
+                    logging.error("Max retries reached. Exiting...")
+                    raise
+
+                retry_delay = next(retry_delays)
+                logging.warning(f"{e}. Retrying in {retry_delay:.1f} seconds")
+                time.sleep(retry_delay)
+
+    def wait_for_submitted_aligned_reads(self, gdc_wrapper):
+        """Polls GDC with short, growing intervals until the committed submitted_aligned_reads can be queried,
+        since GDC can lag a little behind the commit. Returns the GraphQL response."""
+        delay = READINESS_POLL_INITIAL_DELAY
+        waited = 0
+
+        while True:
+            gdc_response = gdc_wrapper.get_entity("sar", self.submitter_id).json()
+            if (gdc_response.get("data") or {}).get("submitted_aligned_reads"):
+                return gdc_response
+
+            if waited >= READINESS_TIMEOUT:
+                return gdc_response
+            logging.info(f"{self.submitter_id} is not visible in GDC yet, checking again in {delay} seconds")
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, READINESS_POLL_MAX_DELAY)
 
     def write_uuid_to_file(self, gdc_wrapper):
-        gdc_response = gdc_wrapper.get_entity("sar", self.submitter_id).json()
+        gdc_response = self.wait_for_submitted_aligned_reads(gdc_wrapper)
 
         if 'data' in gdc_response and gdc_response['data'].get('submitted_aligned_reads'):
             aligned_reads = gdc_response['data']['submitted_aligned_reads']
@@ -73,19 +113,19 @@ class MetadataSubmission:
                     file.write(uuid)
 
                 logging.info("Done writing UUID to file")
+                return uuid
             else:
                 logging.warning("No ids inside the submitted_aligned_reads array")
         else:
             raise RuntimeError("Data was not returned from GDC properly")
 
     def get_file_size(self):
-        client = storage.Client()
         parsed_url = urlparse(self.aggregation_path)
         bucket_name = parsed_url.netloc
         file_path = parsed_url.path.lstrip("/")
 
-        blob = client.bucket(bucket_name).get_blob(file_path)
-        blob.reload()
+        # get_blob already fetches the object's metadata, so there's no need to reload it
+        blob = get_blob(bucket_name, file_path)
         file_size = blob.size
         return int(file_size)
 
@@ -148,6 +188,8 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--data_type', required=True, help='Data type - i.e. WGS')
     parser.add_argument('-md', '--md5', required=True, help='md5 for the file')
     parser.add_argument('-rg', '--read_groups', required=True, help='JSON file with all linked read groups for the sample')
+    parser.add_argument('-l', '--ledger', required=False, help='Submission ledger (SQLite) used to skip work that was already committed')
+    parser.add_argument('--skip_local_validation', action='store_true', help="Don't check the metadata against the GDC dictionary before submitting it, and leave that to GDC")
     args = parser.parse_args()
 
     # Pass command line arguments to the MetadataSubmission class
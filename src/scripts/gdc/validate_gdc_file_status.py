@@ -1,10 +1,13 @@
 import argparse
+import csv
 
 from src.services.gdc_api import GdcApiWrapper
 from src.scripts.extract_reads_metadata_from_json import DATA_TYPE_CONVERSION
 
 
 FILE_STATE_PATH = "/cromwell_root/file_state.txt"
+FILE_STATES_TSV_PATH = "/cromwell_root/file_states.tsv"
+NOT_FOUND_STATE = "not_found"
 
 
 def get_file_status(program, project, sample_alias, aggregation_project, data_type, token):
@@ -20,6 +23,52 @@ def get_file_status(program, project, sample_alias, aggregation_project, data_ty
     else:
         raise ValueError(f"We ran into an issue trying to query GDC - {response_json}")
 
+def get_file_statuses(program, project, submitter_ids, token):
+    """Returns {submitter_id: (state, file_state)} for many submitted_aligned_reads using batched GDC queries.
+    Submitter ids that GDC doesn't have map to None instead of failing the whole lookup."""
+    entities = GdcApiWrapper(program=program, project=project, token=token).get_entities("submitted_aligned_reads", submitter_ids)
+
+    file_statuses = {}
+    for submitter_id, submitted_aligned_reads in entities.items():
+        if not submitted_aligned_reads:
+            print(f"WARNING: No submitted_aligned_reads found in GDC for submitter id: '{submitter_id}'")
+            file_statuses[submitter_id] = None
+        else:
+            file_statuses[submitter_id] = (submitted_aligned_reads[0]["state"], submitted_aligned_reads[0]["file_state"])
+
+    return file_statuses
+
+
+def load_samples(samples_file):
+    """Reads the samples to check from a TSV with the header sample_id, sample_alias, aggregation_project, data_type"""
+    with open(samples_file, "r") as file:
+        return list(csv.DictReader(file, delimiter="\t"))
+
+
+def save_file_states(samples, file_statuses):
+    """Writes one row per sample to a load file for the sample table. Samples GDC doesn't have are marked not_found."""
+    with open(FILE_STATES_TSV_PATH, "w") as file:
+        file.write("entity:sample_id\tfile_state\tstate\n")
+        for sample in samples:
+            status = file_statuses.get(sample["submitter_id"])
+            state, file_state = status if status else (NOT_FOUND_STATE, NOT_FOUND_STATE)
+            file.write(f"{sample['sample_id']}\t{file_state}\t{state}\n")
+
+
+def convert_data_type(data_type):
+    if data_type in DATA_TYPE_CONVERSION.values():
+        # If the provided data type is already an allowed GDC value, use it the way it was provided
+        return data_type
+    try:
+        # Otherwise, attempt to map it to an allowed data type
+        return DATA_TYPE_CONVERSION[data_type]
+    except KeyError:
+        print(
+            f"Provided data type must either be one of the allowed GDC values: ({','.join(DATA_TYPE_CONVERSION.values())}) "
+            f"OR it must be one of the data types we can map: ({','.join(DATA_TYPE_CONVERSION.keys())}). Instead received: '{data_type}'"
+        )
+        return ""
+
 def save_file_state(state_info):
     """Saves the file state information to a file."""
     with open(FILE_STATE_PATH, "w") as file_state_file:
@@ -29,33 +78,44 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Check the current status of file transfer using GDC API.")
     parser.add_argument("--program", required=True, help="GDC program")
     parser.add_argument("--project", required=True, help="GDC project")
-    parser.add_argument("--sample_alias", required=True, help="Sample alias to use when querying GDC")
-    parser.add_argument("--aggregation_project", required=True, help="Aggregation project to use when querying GDC")
-    parser.add_argument("--data_type", required=True, help="Data type to use when querying GDC")
+    parser.add_argument("--sample_alias", required=False, help="Sample alias to use when querying GDC")
+    parser.add_argument("--aggregation_project", required=False, help="Aggregation project to use when querying GDC")
+    parser.add_argument("--data_type", required=False, help="Data type to use when querying GDC")
+    parser.add_argument(
+        "--samples_file",
+        required=False,
+        help="TSV of samples (sample_id, sample_alias, aggregation_project, data_type) to check in batched queries"
+    )
     parser.add_argument("--token", required=True, help="API token to communicate with GDC")
     args = parser.parse_args()
 
-    data_type = ""
-    if args.data_type in DATA_TYPE_CONVERSION.values():
-        # If the provided data type is already an allowed GDC value, use it the way it was provided
-        data_type = args.data_type
-    else:
-        try:
-            # Otherwise, attempt to map it to an allowed data type
-            data_type = DATA_TYPE_CONVERSION[args.data_type]
-        except KeyError:
-            print(
-                f"Provided data type must either be one of the allowed GDC values: ({','.join(DATA_TYPE_CONVERSION.values())}) "
-                f"OR it must be one of the data types we can map: ({','.join(DATA_TYPE_CONVERSION.keys())}). Instead received: '{args.data_type}'"
+    if args.samples_file:
+        samples = load_samples(args.samples_file)
+        for sample in samples:
+            sample["submitter_id"] = (
+                f"{sample['sample_alias']}.{convert_data_type(sample['data_type'])}.{sample['aggregation_project']}"
             )
 
-    state, file_state = get_file_status(
-        program=args.program,
-        project=args.project,
-        sample_alias=args.sample_alias,
-        aggregation_project=args.aggregation_project,
-        data_type=data_type,
-        token=args.token
-    )
-    print(f"Successfully received file status from GDC. \nState - {state}. File_state - {file_state}")
-    save_file_state(f"{file_state}\n{state}")
\ No newline at end of file
+        file_statuses = get_file_statuses(
+            program=args.program,
+            project=args.project,
+            submitter_ids=[sample["submitter_id"] for sample in samples],
+            token=args.token
+        )
+        save_file_states(samples, file_statuses)
+        found = sum(1 for status in file_statuses.values() if status)
+        print(f"Successfully received file status from GDC for {found} of {len(file_statuses)} samples")
+    else:
+        if not all([args.sample_alias, args.aggregation_project, args.data_type]):
+            parser.error("--sample_alias, --aggregation_project and --data_type are required without --samples_file")
+
+        state, file_state = get_file_status(
+            program=args.program,
+            project=args.project,
+            sample_alias=args.sample_alias,
+            aggregation_project=args.aggregation_project,
+            data_type=convert_data_type(args.data_type),
+            token=args.token
+        )
+        print(f"Successfully received file status from GDC. \nState - {state}. File_state - {file_state}")
+        save_file_state(f"{file_state}\n{state}")
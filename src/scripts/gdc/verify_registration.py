@@ -18,12 +18,25 @@ def check_registration(alias, program, project, token):
     else:
         raise RuntimeError(f"Sample is not registered in GDC. Response - {response}")
 
+
+def check_registrations(aliases, program, project, token):
+    """Checks the registration of many aliases with a handful of batched GDC queries"""
+    aliquots = GdcApiWrapper(program=program, project=project, token=token).get_entities("verify", aliases)
+    unregistered = [alias for alias, aliquot in aliquots.items() if not aliquot]
+
+    if unregistered:
+        raise RuntimeError(f"Samples are not registered in GDC - {', '.join(unregistered)}")
+    logging.info("true")
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Verify sample registration in GDC")
-    parser.add_argument('-s', '--sample_alias', required=True, help='list of aliases to check registration status')
+    parser.add_argument('-s', '--sample_alias', required=True, nargs='+', help='list of aliases to check registration status')
     parser.add_argument('-t', '--token', required=True, help='Api token to communicate with GDC')
     parser.add_argument('-pg', '--program', required=True, help='GDC program')
     parser.add_argument('-pj', '--project', required=True, help='GDC project')
     args = parser.parse_args()
 
-    check_registration(args.sample_alias, args.program, args.project, args.token)
\ No newline at end of file
+    if len(args.sample_alias) == 1:
+        check_registration(args.sample_alias[0], args.program, args.project, args.token)
+    else:
+        check_registrations(args.sample_alias, args.program, args.project, args.token)
\ No newline at end of file
@@ -0,0 +1,10 @@
+import random
+
+
+def decorrelated_jitter(base, cap):
+    """Yields retry delays (in seconds) that grow exponentially from base up to cap, with decorrelated jitter
+    so that tasks which failed at the same moment spread their retries out instead of colliding again."""
+    delay = base
+    while True:
+        delay = min(cap, random.uniform(base, delay * 3))
+        yield delay
@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+import httplib2
+from oauth2client.client import GoogleCredentials
+
+SCOPES = ["https://www.googleapis.com/auth/userinfo.profile", "https://www.googleapis.com/auth/userinfo.email"]
+# Refresh this many seconds before the token expires, so no request goes out with a token about to lapse
+REFRESH_MARGIN = 300
+# Set to share tokens between processes on the same VM. Off by default since it puts a bearer token on disk.
+TOKEN_CACHE_PATH = os.environ.get("ACCESS_TOKEN_CACHE_PATH")
+DEFAULT_TOKEN_LIFETIME = 3600  # in seconds, used if the credentials don't say when the token expires
+
+
+class AccessTokenProvider:
+    """Hands out a cached access token for the application default credentials, refreshing it shortly before it
+    expires. Safe to share between threads."""
+
+    def __init__(self, scopes=SCOPES, cache_path=TOKEN_CACHE_PATH, refresh_margin=REFRESH_MARGIN):
+        self.scopes = scopes
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._access_token = None
+        self._expires_at = 0
+
+    def _is_fresh(self, expires_at):
+        return time.time() < expires_at - self.refresh_margin
+
+    def _read_cache_file(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cached if self._is_fresh(cached.get("expires_at", 0)) else None
+
+    def _write_cache_file(self):
+        # mkstemp creates the file so only the current user can read the token
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path) or ".", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"access_token": self._access_token, "expires_at": self._expires_at}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _refresh(self):
+        if self._credentials is None:
+            self._credentials = GoogleCredentials.get_application_default().create_scoped(self.scopes)
+
+        token_info = self._credentials.get_access_token()
+        if token_info.expires_in is not None and token_info.expires_in <= self.refresh_margin:
+            # The credentials hand back their current token until it has actually expired, so force a new one
+            self._credentials.refresh(httplib2.Http())
+            token_info = self._credentials.get_access_token()
+
+        self._access_token = token_info.access_token
+        self._expires_at = time.time() + (token_info.expires_in or DEFAULT_TOKEN_LIFETIME)
+
+    def get_access_token(self):
+        with self._lock:
+            if self._access_token and self._is_fresh(self._expires_at):
+                return self._access_token
+
+            cached = self._read_cache_file() if self.cache_path else None
+            if cached:
+                self._access_token = cached["access_token"]
+                self._expires_at = cached["expires_at"]
+                return self._access_token
+
+            self._refresh()
+            if self.cache_path:
+                self._write_cache_file()
+            return self._access_token
+
+
+_default_provider = AccessTokenProvider()
+
+
+def get_access_token():
+    """Get access token."""
+    return _default_provider.get_access_token()
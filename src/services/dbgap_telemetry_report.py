@@ -1,5 +1,22 @@
+import fcntl
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
 import requests
 import xmltodict
+from lxml import etree
+
+# Reports are shared by every task running on the same VM, so keep them somewhere all of them can see
+TELEMETRY_CACHE_DIR = os.environ.get("DBGAP_TELEMETRY_CACHE_DIR", "/tmp/dbgap_telemetry_cache")
+# How long (in seconds) a downloaded report is trusted before we ask dbGaP whether it changed
+TELEMETRY_CACHE_TTL = int(os.environ.get("DBGAP_TELEMETRY_CACHE_TTL", 3600))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Status reported for a sample that is in the study but has no SRA status for the data type (e.g. no SRAData yet)
+NO_SRA_STATUS = "no_sra_data"
+
 
 class SampleNotFoundError(Exception):
     """Exception raised when a sample is not found."""
@@ -7,23 +24,247 @@ class SampleNotFoundError(Exception):
         self.alias = alias
         super().__init__(f"Sample with alias '{alias}' not found")
 
+
+class TelemetryReportCache:
+    """On-disk cache of telemetry reports, one XML file per phs_id.
+
+    Concurrent processes serialize on a per-study lock file, so only one of them downloads a report while
+    the others wait and then read the fresh copy. Once the TTL expires the report is revalidated with
+    If-None-Match/If-Modified-Since, so an unchanged study costs a 304 instead of a full download.
+    """
+
+    def __init__(self, cache_dir=TELEMETRY_CACHE_DIR, ttl=TELEMETRY_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, phs_id, extension):
+        return os.path.join(self.cache_dir, f"{phs_id}.{extension}")
+
+    @contextmanager
+    def _lock(self, phs_id):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._path(phs_id, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_metadata(self, phs_id):
+        try:
+            with open(self._path(phs_id, "json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_metadata(self, phs_id, metadata):
+        tmp_path = self._path(phs_id, "json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, self._path(phs_id, "json"))
+
+    def get_report_path(self, phs_id, fetch):
+        """Returns the path of an up to date report for the study, downloading it with fetch(headers) if needed."""
+        report_path = self._path(phs_id, "xml")
+
+        with self._lock(phs_id):
+            metadata = self._read_metadata(phs_id)
+            if metadata is None or not os.path.exists(report_path):
+                metadata = {}
+            elif time.time() - metadata.get("fetched_at", 0) < self.ttl:
+                print(f"Using cached telemetry report for {phs_id}")
+                return report_path
+
+            conditional_headers = {}
+            if metadata.get("etag"):
+                conditional_headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                conditional_headers["If-Modified-Since"] = metadata["last_modified"]
+
+            response = fetch(conditional_headers)
+            with response:
+                if response.status_code == 304:
+                    print(f"Telemetry report for {phs_id} has not changed since it was cached")
+                else:
+                    # Raise an HTTPError for bad responses (4xx or 5xx)
+                    response.raise_for_status()
+
+                    tmp_path = self._path(phs_id, "xml.tmp")
+                    with open(tmp_path, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                    # Readers that already opened the old report keep their handle, so swap it in atomically
+                    os.replace(tmp_path, report_path)
+                    print(f"Downloaded telemetry report for {phs_id}")
+
+                    metadata = {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                    }
+
+            metadata["fetched_at"] = time.time()
+            self._write_metadata(phs_id, metadata)
+
+        return report_path
+
+
+class TelemetryStatusSnapshot:
+    """SQLite file holding the per-sample, per-experiment-type statuses that earlier sweeps wrote to Terra.
+
+    Only statuses that were actually emitted are recorded, so a sample that has never been written - e.g. one
+    from a different cohort of the same study - always counts as changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS sample_status (
+                    phs_id TEXT NOT NULL,
+                    submitted_sample_id TEXT NOT NULL,
+                    experiment_type TEXT NOT NULL,
+                    status TEXT,
+                    PRIMARY KEY (phs_id, submitted_sample_id, experiment_type)
+                ) WITHOUT ROWID"""
+            )
+
+    def load(self, phs_id):
+        """Returns the study's statuses as {(submitted_sample_id, experiment_type): status}"""
+        with sqlite3.connect(self.path) as connection:
+            rows = connection.execute(
+                "SELECT submitted_sample_id, experiment_type, status FROM sample_status WHERE phs_id = ?", (phs_id,)
+            )
+            # NULL can't be part of the primary key, so the "any data type" status is stored under ''
+            return {(alias, experiment_type or None): status for alias, experiment_type, status in rows}
+
+    def record(self, phs_id, statuses):
+        """Records the given {(submitted_sample_id, experiment_type): status} as written, leaving the rest of the
+        study's statuses alone"""
+        with sqlite3.connect(self.path) as connection:
+            connection.executemany(
+                """INSERT INTO sample_status VALUES (?, ?, ?, ?)
+                   ON CONFLICT (phs_id, submitted_sample_id, experiment_type) DO UPDATE SET status = excluded.status""",
+                ((phs_id, alias, experiment_type or "", status)
+                 for (alias, experiment_type), status in statuses.items())
+            )
+
+
 class DbgapTelemetryWrapper:
-    def __init__(self, phs_id=None):
+    def __init__(self, phs_id=None, cache=None, streaming=True):
         self.endpoint = f"https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/GetSampleStatus.cgi?rettype=xml&study_id={phs_id}"
         self.phs_id = phs_id
+        self.cache = cache if cache is not None else TelemetryReportCache()
+        # When streaming, samples are parsed one at a time instead of building the whole report in memory
+        self.streaming = streaming
+        self._telemetry_data = None
+        # submitted_sample_id -> sample record and (submitted_sample_id, experiment_type) -> status, see _build_index
+        self._sample_index = None
+        self._status_index = None
+
+    def _request_telemetry_report(self, headers=None):
+        return requests.get(
+            self.endpoint,
+            headers={"Content-Type": "application/json", **(headers or {})},
+            stream=True
+        )
+
+    def _get_report_path(self):
+        return self.cache.get_report_path(self.phs_id, self._request_telemetry_report)
 
     def _call_telemetry_report(self):
         """Example xml - https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/GetSampleStatus.cgi?rettype=xml&study_id=phs000452"""
-        response = requests.get(
-            self.endpoint, 
-            headers={"Content-Type": "application/json"}
+        if self._telemetry_data is None:
+            with open(self._get_report_path(), "rb") as report:
+                self._telemetry_data = xmltodict.parse(report)
+
+        return self._telemetry_data
+
+    def _iter_samples(self):
+        """Yields each Sample of the report, in the same dict form xmltodict gives it, without loading the whole report"""
+        for _, element in etree.iterparse(self._get_report_path(), events=("end",), tag="Sample"):
+            yield xmltodict.parse(etree.tostring(element))["Sample"]
+
+            # Free the element and the siblings we have already looked at so memory stays flat
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def _iter_all_samples(self):
+        if self.streaming:
+            yield from self._iter_samples()
+        else:
+            sample_list = self._call_telemetry_report()["DbGap"]["Study"]["SampleList"]["Sample"]
+            # xmltodict only gives us a list when the study has more than one sample
+            yield from sample_list if isinstance(sample_list, list) else [sample_list]
+
+    def _build_index(self):
+        """Indexes every sample in the report in a single pass so any number of lookups cost O(1) each"""
+        if self._sample_index is not None:
+            return
+
+        sample_index = {}
+        status_index = {}
+        for sample in self._iter_all_samples():
+            alias = sample.get("@submitted_sample_id")
+            sample_index[alias] = {
+                key: sample[key] for key in ("@repository", "@submitted_subject_id") if key in sample
+            }
+
+            for experiment_type, status in self._get_sra_statuses(sample).items():
+                status_index[(alias, experiment_type)] = status
+
+        self._sample_index = sample_index
+        self._status_index = status_index
+
+    @staticmethod
+    def _get_sra_statuses(sample):
+        """Returns {experiment_type: status} from the sample's SRA stats, which is empty if it has none. A sample
+        with a single stat reports that status whatever data type is asked for, so it is also under None."""
+        sra_sample_stats = (sample.get("SRAData") or {}).get("Stats")
+        if isinstance(sra_sample_stats, list):
+            statuses = {}
+            for stat in sra_sample_stats:
+                statuses.setdefault(stat.get("@experiment_type"), stat.get("@status"))
+            return statuses
+        if isinstance(sra_sample_stats, dict):
+            return {
+                sra_sample_stats.get("@experiment_type"): sra_sample_stats.get("@status"),
+                None: sra_sample_stats.get("@status"),
+            }
+        return {}
+
+    @staticmethod
+    def _pick_status(statuses, data_type):
+        status = statuses[data_type] if data_type in statuses else statuses.get(None)
+        return status or NO_SRA_STATUS
+
+    def _get_indexed_status(self, alias, data_type):
+        return self._pick_status(
+            {
+                experiment_type: self._status_index[(alias, experiment_type)]
+                for experiment_type in (data_type, None) if (alias, experiment_type) in self._status_index
+            },
+            data_type
         )
-        # Raise an HTTPError for bad responses (4xx or 5xx)
-        response.raise_for_status()
 
-        return xmltodict.parse(response.text)
+    @staticmethod
+    def _format_sample_info(alias, sample):
+        try:
+            return {
+                "repository": sample["@repository"],
+                "submitted_subject_id": sample["@submitted_subject_id"]
+            }
+        except KeyError as e:
+            raise KeyError(f"Key error occurred when accessing {e} in sample with alias '{alias}'")
 
     def _get_sample(self, alias):
+        if self.streaming:
+            for sample in self._iter_samples():
+                if sample.get("@submitted_sample_id") == alias:
+                    return sample
+
+            raise SampleNotFoundError(alias)
+
         try:
             telemetry_data = self._call_telemetry_report()
             study_data = telemetry_data["DbGap"]["Study"]
@@ -40,23 +281,45 @@ class DbgapTelemetryWrapper:
             raise e
 
     def get_sample_status(self, alias, data_type):
-        sample = self._get_sample(alias)
-        sra_data = sample["SRAData"]
-        sra_sample_stats = sra_data["Stats"]
+        """Returns the sample's SRA status for data_type, or NO_SRA_STATUS if it has none, whether or not the
+        report has been indexed yet. Raises SampleNotFoundError if the sample isn't in the study."""
+        if self._sample_index is not None:
+            if alias not in self._sample_index:
+                raise SampleNotFoundError(alias)
+            return self._get_indexed_status(alias, data_type)
 
-        if isinstance(sra_sample_stats, list):
-            for stat in sra_sample_stats:
-                if stat.get("@experiment_type") == data_type:
-                    return stat["@status"]
-        elif isinstance(sra_sample_stats, dict):
-            return sra_sample_stats["@status"]
+        return self._pick_status(self._get_sra_statuses(self._get_sample(alias)), data_type)
 
     def get_sample_info(self, alias):
-        sample = self._get_sample(alias)
-        try:
-            return {
-                "repository": sample["@repository"],
-                "submitted_subject_id": sample["@submitted_subject_id"]
-            }
-        except KeyError as e:
-            raise KeyError(f"Key error occurred when accessing {e} in sample with alias '{alias}'")
+        if self._sample_index is not None:
+            if alias not in self._sample_index:
+                raise SampleNotFoundError(alias)
+            return self._format_sample_info(alias, self._sample_index[alias])
+
+        return self._format_sample_info(alias, self._get_sample(alias))
+
+    def get_sample_statuses(self, aliases, data_type):
+        """Returns {alias: status} for every alias found in the report, reading the report only once"""
+        self._build_index()
+        return {
+            alias: self._get_indexed_status(alias, data_type) for alias in aliases if alias in self._sample_index
+        }
+
+    def get_sample_infos(self, aliases):
+        """Returns {alias: sample info} for every alias found in the report, reading the report only once"""
+        self._build_index()
+        return {
+            alias: self._format_sample_info(alias, self._sample_index[alias])
+            for alias in aliases if alias in self._sample_index
+        }
+
+    def get_changed_sample_statuses(self, aliases, data_type, snapshot):
+        """Like get_sample_statuses, but only returns the aliases whose status differs from the one last written
+        for (alias, data_type), including aliases that have never been written"""
+        previous_statuses = snapshot.load(self.phs_id)
+
+        return {
+            alias: status for alias, status in self.get_sample_statuses(aliases, data_type).items()
+            if (alias, data_type) not in previous_statuses or previous_statuses[(alias, data_type)] != status
+        }
+
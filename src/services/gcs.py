@@ -0,0 +1,120 @@
+import functools
+import hashlib
+import os
+import tempfile
+
+import orjson
+from google.cloud import storage
+
+GCS_CONTENT_CACHE_DIR = os.environ.get("GCS_CONTENT_CACHE_DIR", "/tmp/gcs_content_cache")
+STREAM_CHUNK_SIZE = 1024 * 1024  # bytes read from GCS at a time when streaming an object
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+    """Returns the process-wide storage client, so credentials and connections are set up only once"""
+    return storage.Client()
+
+
+def get_blob(bucket_name, file_path):
+    """Returns the blob with its metadata (including generation), or raises FileNotFoundError.
+    client.bucket() doesn't make a request, so this is a single metadata GET."""
+    blob = get_storage_client().bucket(bucket_name).get_blob(file_path)
+    if blob is None:
+        raise FileNotFoundError(f"Blob not found: gs://{bucket_name}/{file_path}")
+    return blob
+
+
+class _CacheFillingStream:
+    """Wraps a GCS read stream, copying everything read into a temporary file in the cache directory. Once the
+    whole object has been read, the file is moved into place as the cache entry; if reading stops early it is
+    thrown away, so a partial copy can never be served from the cache."""
+
+    def __init__(self, stream, cache_path):
+        self._stream = stream
+        self._cache_path = cache_path
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        self._tmp_file = os.fdopen(fd, "wb")
+        self._at_eof = False
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        if data:
+            self._tmp_file.write(data)
+        if not data or size is None or size < 0:
+            self._at_eof = True
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self._tmp_file.closed:
+            return
+        self._stream.close()
+        self._tmp_file.close()
+        if self._at_eof:
+            os.replace(self._tmp_path, self._cache_path)
+        else:
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GcsContentCache:
+    """Local copies of GCS objects keyed by (bucket, path, generation).
+
+    A generation number changes whenever an object is overwritten, so a cached copy for the current
+    generation is always the current content and can be used without downloading the object again.
+    """
+
+    def __init__(self, cache_dir=GCS_CONTENT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _get_cache_path(self, bucket_name, file_path, generation):
+        path_hash = hashlib.sha256(file_path.encode()).hexdigest()
+        return os.path.join(self.cache_dir, bucket_name, f"{path_hash}.{generation}")
+
+    def get_bytes(self, bucket_name, file_path):
+        blob = get_blob(bucket_name, file_path)
+        cache_path = self._get_cache_path(bucket_name, file_path, blob.generation)
+
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return f.read()
+
+        # Pin the generation we looked up, so the download can't pick up a newer version than the cache key says
+        content = blob.download_as_bytes(if_generation_match=blob.generation)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # A unique temporary file, since threads of the same process can download the same object at once
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+        return content
+
+    def open_stream(self, bucket_name, file_path):
+        """Returns a binary file object for the object's content, read from the cache if this generation is there
+        and otherwise streamed from GCS a chunk at a time, without downloading the whole object first. A streamed
+        object is added to the cache once it has been read to the end."""
+        blob = get_blob(bucket_name, file_path)
+        cache_path = self._get_cache_path(bucket_name, file_path, blob.generation)
+
+        if os.path.exists(cache_path):
+            return open(cache_path, "rb")
+        stream = blob.open("rb", chunk_size=STREAM_CHUNK_SIZE, if_generation_match=blob.generation)
+        return _CacheFillingStream(stream, cache_path)
+
+    def get_json(self, bucket_name, file_path):
+        # orjson parses the downloaded bytes directly, without decoding them to a str first
+        return orjson.loads(self.get_bytes(bucket_name, file_path))
+
+
+@functools.lru_cache(maxsize=None)
+def get_content_cache(cache_dir=GCS_CONTENT_CACHE_DIR):
+    return GcsContentCache(cache_dir=cache_dir)
@@ -1,51 +1,318 @@
+import asyncio
 import requests
 import json
 import logging
+import random
+import time
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
+
+from src.services.gdc_dictionary import get_gdc_dictionary
 
 logging.basicConfig(
     format="%(levelname)s: %(asctime)s : %(message)s", level=logging.INFO
 )
 
+CONNECT_TIMEOUT = 10  # in seconds
+READ_TIMEOUT = 300  # in seconds, GDC dry runs of large payloads can take a while
+QUERY_READ_TIMEOUT = 60  # in seconds, for GraphQL lookups, manifests and other reads
+MAX_RETRIES = 5
+MAX_RETRY_DURATION = 300  # in seconds, after the first failure, before a request is given up on
+BACKOFF_FACTOR = 2
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+GRAPHQL_BATCH_SIZE = 50  # lookups packed into a single GraphQL request
+TRANSACTION_MAX_ENTITIES = 500  # entities packed into one bulk submission transaction
+TRANSACTION_MAX_BYTES = 5 * 1024 * 1024  # serialized size of one bulk submission transaction
+MAX_SPLIT_DEPTH = 4  # times a rejected transaction is split up again to isolate the entities GDC rejects
+ASYNC_MAX_CONCURRENCY = 20  # requests in flight at once per AsyncGdcApiWrapper
+ASYNC_REQUESTS_PER_SECOND = 10
+
+
+class GdcSubmissionError(Exception):
+    """Raised when GDC rejects a submission. retryable is set when the failure came from a conflicting
+    transaction or from GDC being overloaded or unavailable, rather than from the metadata itself.
+
+    When the dry run said why it failed, entity_errors holds {submitter_id: [messages]} for the entities GDC
+    rejected and transactional_errors the messages about the transaction as a whole.
+    """
+    def __init__(self, message, status_code=None, retryable=None, entity_errors=None, transactional_errors=None):
+        self.status_code = status_code
+        if retryable is None:
+            retryable = status_code is not None and (status_code in (409, 429) or status_code >= 500)
+        self.retryable = retryable
+        self.entity_errors = entity_errors or {}
+        self.transactional_errors = transactional_errors or []
+        super().__init__(message)
+
+    @property
+    def signature(self):
+        """What went wrong, without the transaction id, so failures of different transactions can be compared"""
+        return self.status_code, tuple(sorted(self.transactional_errors)), tuple(
+            sorted(message for messages in self.entity_errors.values() for message in messages)
+        )
+
+    @classmethod
+    def from_dry_run(cls, dry_run_response, status_code):
+        """Builds the error for a failed dry run from the per-entity and transactional errors GDC returned"""
+        entity_errors = {}
+        for entity in dry_run_response.get("entities") or []:
+            if not entity.get("errors"):
+                continue
+            submitter_id = entity.get("submitter_id") or next(
+                (keys["submitter_id"] for keys in entity.get("unique_keys") or [] if keys.get("submitter_id")), None
+            )
+            entity_errors[submitter_id] = [error.get("message", str(error)) for error in entity["errors"]]
+
+        transactional_errors = [
+            error.get("message", str(error)) if isinstance(error, dict) else str(error)
+            for error in dry_run_response.get("transactional_errors") or []
+        ]
+        details = "; ".join(transactional_errors + [f"{sid}: {', '.join(msgs)}" for sid, msgs in entity_errors.items()])
+        return cls(
+            f"Could not submit metadata for transaction {dry_run_response.get('transaction_id')}"
+            + (f" - {details}" if details else ""),
+            status_code=status_code,
+            entity_errors=entity_errors,
+            transactional_errors=transactional_errors,
+        )
+
+
+class JitteredRetry(Retry):
+    """urllib3 Retry whose exponential backoff is randomised, so tasks that failed together don't retry together.
+    A Retry-After header sent with a 429 or 503 still takes precedence over the backoff.
+
+    Retrying stops once max_duration seconds have passed since the first failure, however many retries are left.
+    """
+
+    def __init__(self, *args, max_duration=MAX_RETRY_DURATION, first_failure_at=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_duration = max_duration
+        self.first_failure_at = first_failure_at
+
+    def new(self, **kwargs):
+        kwargs.setdefault("max_duration", self.max_duration)
+        kwargs.setdefault("first_failure_at", self.first_failure_at)
+        return super().new(**kwargs)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        now = time.monotonic()
+        if self.first_failure_at is not None and now - self.first_failure_at > self.max_duration:
+            raise MaxRetryError(_pool, url, error or f"gave up retrying after {self.max_duration} seconds")
+
+        new_retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if new_retry.first_failure_at is None:
+            new_retry.first_failure_at = now
+        return new_retry
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(backoff / 2, backoff)
+
+
+def create_session(max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, pool_maxsize=10,
+                   max_retry_duration=MAX_RETRY_DURATION):
+    """Creates a session that keeps connections to GDC alive between calls and retries throttled or failed reads.
+
+    Submission PUTs (dry runs and transaction commits/closes) are only retried when the connection couldn't be made,
+    since replaying one GDC may already have applied would report a successful commit as a failure. Other failures
+    of those are raised as GdcSubmissionError for the submit-level retry to handle.
+    """
+    retry = JitteredRetry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        # GraphQL queries are POSTs but only read data, so they are as safe to retry as GETs
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        max_duration=max_retry_duration,
+        # Hand the last response back to the caller instead of raising, so it can be logged like any other failure
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_maxsize)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+class GdcRequestBuilder:
+    """Query builders and validation shared by GdcApiWrapper and AsyncGdcApiWrapper. Expects program, project,
+    token and validate_locally to be set on the instance."""
+
+    def validate_metadata(self, metadata):
+        """Validates one entity or a list of them against the local GDC dictionary.
+
+        Returns a dict of submitter_id -> list of problems, only for the entities that have problems.
+        """
+        entities = metadata if isinstance(metadata, list) else [metadata]
+        try:
+            dictionary = get_gdc_dictionary().load()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.warning(f"Could not load the GDC dictionary, leaving validation to GDC: {e}")
+            return {}
+
+        invalid = {}
+        for entity in entities:
+            errors = dictionary.validate(entity)
+            if errors:
+                invalid[entity.get("submitter_id")] = errors
+        return invalid
+
+    @staticmethod
+    def get_query_entity(query_type):
+        """Returns the GDC entity and the fields beyond its id to fetch for the given query type"""
+        if query_type == "sar":
+            entity = "submitted_aligned_reads"
+            additional_fields = ""
+        elif query_type == "verify":
+            entity = "aliquot"
+            additional_fields = ""
+        elif query_type == "read_group":
+            entity = "read_group"
+            additional_fields = ""
+        else:
+            entity = "submitted_aligned_reads"
+            additional_fields = """
+                submitter_id
+                state
+                file_state
+                error_type
+            """
+
+        return entity, additional_fields
+
+    def construct_query(self, query_type, submitter_id):
+        base_query = """
+        {{
+            {entity} (project_id: "{program}-{project}", submitter_id: "{submitter_id}") {{
+                id
+                {additional_fields}
+            }}
+        }}
+        """
+        entity, additional_fields = self.get_query_entity(query_type)
+
+        return {
+            "query": base_query.format(entity=entity, program=self.program, project=self.project, submitter_id=submitter_id, additional_fields=additional_fields)
+        }
 
-class GdcApiWrapper:
-    def __init__(self, program=None, project=None, token=None):
+    def construct_batch_query(self, query_type, submitter_ids):
+        """Packs one aliased lookup per submitter_id (q0, q1, ...) into a single GraphQL document"""
+        entity, additional_fields = self.get_query_entity(query_type)
+        lookups = "".join(
+            f"""
+            q{index}: {entity} (project_id: "{self.program}-{self.project}", submitter_id: {json.dumps(submitter_id)}) {{
+                id
+                {additional_fields}
+            }}"""
+            for index, submitter_id in enumerate(submitter_ids)
+        )
+
+        return {"query": f"{{{lookups}\n}}"}
+
+    def get_headers(self):
+        return {
+            "Content-Type": "application/json", 
+            "X-Auth-Token": self.token
+        }
+
+
+class GdcApiWrapper(GdcRequestBuilder):
+    def __init__(self, program=None, project=None, token=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, validate_locally=True,
+                 query_read_timeout=QUERY_READ_TIMEOUT):
         self.endpoint = 'https://api.gdc.cancer.gov/v0/submission'
         self.program = program
         self.project = project
         self.token = token
+        # Submissions get the long read timeout, lookups a short one so a hung read is retried sooner
+        self.timeout = (connect_timeout, read_timeout)
+        self.query_timeout = (connect_timeout, query_read_timeout)
+        self.session = create_session(max_retries=max_retries, backoff_factor=backoff_factor)
+        # Check payloads against the cached GDC dictionary before spending a dry run on them
+        self.validate_locally = validate_locally
+        self.last_transaction_id = None
 
     def get_entity(self, query_type, submitter_id):
         """Constructs GraphQL query to hit the GDC API"""
 
         query = self.construct_query(query_type, submitter_id)
 
-        return requests.post(
+        return self.session.post(
             f"{self.endpoint}/graphql",
             json=query,
-            headers=self.get_headers()
+            headers=self.get_headers(),
+            timeout=self.query_timeout
         )
 
+    def get_entities(self, query_type, submitter_ids, chunk_size=GRAPHQL_BATCH_SIZE):
+        """Looks up many submitter_ids with one GraphQL request per chunk.
+
+        Returns a dict of submitter_id -> list of matching entities, which is empty if the entity doesn't exist.
+        """
+        submitter_ids = list(dict.fromkeys(submitter_ids))
+        entities = {}
+
+        for start in range(0, len(submitter_ids), chunk_size):
+            chunk = submitter_ids[start:start + chunk_size]
+            response = self.session.post(
+                f"{self.endpoint}/graphql",
+                json=self.construct_batch_query(query_type, chunk),
+                headers=self.get_headers(),
+                timeout=self.query_timeout
+            )
+            response_json = response.json()
+
+            if not response_json.get("data"):
+                raise RuntimeError(f"Data was not returned from GDC properly - {response_json}")
+
+            for index, submitter_id in enumerate(chunk):
+                entities[submitter_id] = response_json["data"].get(f"q{index}") or []
+
+        return entities
+
     def get_gdc_schemas(self):
         """Queries GDC to get a specific schema. Replace submitted_aligned_reads with any GDC entity"""
 
-        response = requests.get(f'{self.endpoint}/template/submitted_aligned_reads?format=json')
+        response = self.session.get(f'{self.endpoint}/template/submitted_aligned_reads?format=json', timeout=self.query_timeout)
         with open('src/resources/sample_template.json', 'w') as f:
             f.write(response.text)
 
+    def get_manifest(self, ids):
+        """Retrieves the gdc-client upload manifest (yaml) for the given entity UUIDs"""
+
+        response = self.session.get(
+            f"{self.endpoint}/{self.program}/{self.project}/manifest",
+            params={"ids": ",".join(ids)},
+            headers=self.get_headers(),
+            timeout=self.query_timeout
+        )
+        response.raise_for_status()
+        return response.text
+
     def submit_metadata(self, metadata):
         """Submits the formatted metadata to GDC API"""
 
         url = f"{self.endpoint}/{self.program}/{self.project}"
 
+        if self.validate_locally:
+            invalid = self.validate_metadata(metadata)
+            if invalid:
+                raise GdcSubmissionError(f"Metadata failed validation against the GDC dictionary: {invalid}")
+
         logging.info(
             f"Submitting metadata to GDC dry_run endpoint for program {self.program} in project {self.project}"
         )
         try:
-            dry_run_response = requests.put(
+            dry_run = self.session.put(
                 f"{url}/_dry_run",
                 data=json.dumps(metadata),
-                headers=self.get_headers()
-            ).json()
+                headers=self.get_headers(),
+                timeout=self.timeout
+            )
+            dry_run_response = dry_run.json()
 
             logging.info(f"Response for the dry commit: {dry_run_response}")
             transaction_id = dry_run_response.get("transaction_id")
@@ -53,57 +320,348 @@ class GdcApiWrapper:
             if dry_run_response.get("success"):
                 logging.info(f"Successfully submitted metadata for transaction {transaction_id}")
                 operation = "commit"
-                commit_response = requests.put(
+                commit_response = self.session.put(
                     url=f"{url}/transactions/{transaction_id}/{operation}",
-                    headers=self.get_headers()
+                    headers=self.get_headers(),
+                    timeout=self.timeout
                 )
                 logging.info(f"Response for the '{operation}' operation: {commit_response.status_code}")
+                if commit_response.status_code >= 400:
+                    raise GdcSubmissionError(
+                        f"Could not commit transaction {transaction_id}: {commit_response.text}",
+                        status_code=commit_response.status_code
+                    )
+                self.last_transaction_id = transaction_id
 
             else:
                 logging.error(f"Could not submit metadata for transaction {transaction_id}")
                 operation = "close"
-                commit_response = requests.put(
+                commit_response = self.session.put(
                     f"{url}/transactions/{transaction_id}/{operation}",
-                    headers=self.get_headers()
+                    headers=self.get_headers(),
+                    timeout=self.timeout
                 )
                 logging.warning(f"Response for the '{operation}' operation: {commit_response.status_code}")
-                raise Exception(f"Could not submit metadata for transaction {transaction_id}")
+                raise GdcSubmissionError.from_dry_run(dry_run_response, dry_run.status_code)
 
             return operation
 
+        except GdcSubmissionError:
+            raise
+        except requests.exceptions.RequestException as e:
+            # The session already retried, but GDC being unreachable is still worth another attempt later
+            raise GdcSubmissionError(f"Error: {e}", retryable=True)
         except Exception as e:
-            raise Exception(f"Error: {e}")
+            raise GdcSubmissionError(f"Error: {e}")
 
-    def construct_query(self, query_type, submitter_id):
-        base_query = """
-        {{
-            {entity} (project_id: "{program}-{project}", submitter_id: "{submitter_id}") {{
-                id
-                {additional_fields}
-            }}
-        }}
+    def submit_entities(self, entities, max_entities=TRANSACTION_MAX_ENTITIES, max_bytes=TRANSACTION_MAX_BYTES,
+                        atomic=False):
+        """Submits entities from any number of samples in as few size-bounded transactions as possible.
+
+        When GDC rejects a transaction, the entities its dry run flagged fail on their own and the rest are
+        submitted again, so one bad record only fails itself. If the dry run doesn't say which entities were at
+        fault, the transaction is split in half, unless both halves fail the same way. With atomic, the entities are
+        committed all together or not at all: they must fit in one transaction (ValueError is raised before anything
+        is submitted if they don't), and a rejection fails all of them. Entities are always submitted in the order given,
+        so list read groups before the submitted_aligned_reads that link to them. Returns a dict of submitter_id ->
+        outcome, where each outcome has a "status" of "committed" or "failed", plus an "error" and a "retryable"
+        flag for failures.
         """
+        chunks = list(self._chunk_entities(entities, max_entities, max_bytes))
+        if atomic and len(chunks) > 1:
+            raise ValueError(
+                f"Can't submit {len(entities)} entities atomically, since they need {len(chunks)} transactions"
+            )
 
-        if query_type == "sar":
-            entity = "submitted_aligned_reads"
-            additional_fields = ""
-        elif query_type == "verify":
-            entity = "aliquot"
-            additional_fields = ""
-        else:
-            entity = "submitted_aligned_reads"
-            additional_fields = """
-                submitter_id
-                state
-                file_state
-                error_type
-            """
+        outcomes = {}
+        if self.validate_locally:
+            invalid = self.validate_metadata(entities)
+            if invalid and atomic:
+                for entity in entities:
+                    error = "; ".join(invalid.get(entity.get("submitter_id"), ["Another entity in the transaction is invalid"]))
+                    outcomes[entity["submitter_id"]] = {"status": "failed", "error": error, "retryable": False}
+                return outcomes
+            for submitter_id, errors in invalid.items():
+                outcomes[submitter_id] = {"status": "failed", "error": "; ".join(errors), "retryable": False}
+            if invalid:
+                entities = [entity for entity in entities if entity.get("submitter_id") not in invalid]
+                chunks = list(self._chunk_entities(entities, max_entities, max_bytes))
 
-        return {
-            "query": base_query.format(entity=entity, program=self.program, project=self.project, submitter_id=submitter_id, additional_fields=additional_fields)
-        }
-    def get_headers(self):
-        return {
-            "Content-Type": "application/json", 
-            "X-Auth-Token": self.token
-        }
\ No newline at end of file
+        for chunk in chunks:
+            error = self._attempt_chunk(chunk, outcomes)
+            if error:
+                self._handle_rejected_chunk(chunk, error, outcomes, depth=0 if not atomic else MAX_SPLIT_DEPTH)
+
+        failed = [submitter_id for submitter_id, outcome in outcomes.items() if outcome["status"] == "failed"]
+        logging.info(f"Committed {len(outcomes) - len(failed)} of {len(outcomes)} entities")
+        if failed:
+            logging.error(f"Failed to submit: {', '.join(failed)}")
+        return outcomes
+
+    @staticmethod
+    def _chunk_entities(entities, max_entities, max_bytes):
+        chunk = []
+        chunk_bytes = 0
+        for entity in entities:
+            entity_bytes = len(json.dumps(entity))
+            if chunk and (len(chunk) >= max_entities or chunk_bytes + entity_bytes > max_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(entity)
+            chunk_bytes += entity_bytes
+        if chunk:
+            yield chunk
+
+    def _attempt_chunk(self, chunk, outcomes):
+        """Submits one transaction. Records the outcome if it was committed, otherwise returns the error."""
+        try:
+            self.submit_metadata(chunk)
+        except GdcSubmissionError as e:
+            return e
+
+        for entity in chunk:
+            outcomes[entity["submitter_id"]] = {"status": "committed", "transaction_id": self.last_transaction_id}
+        return None
+
+    @staticmethod
+    def _fail_entities(entities, error, outcomes):
+        for entity in entities:
+            messages = error.entity_errors.get(entity["submitter_id"])
+            outcomes[entity["submitter_id"]] = {
+                "status": "failed",
+                "error": "; ".join(messages) if messages else str(error),
+                "retryable": error.retryable,
+            }
+
+    def _handle_rejected_chunk(self, chunk, error, outcomes, depth):
+        # Splitting won't help when GDC itself is the problem, so leave those for the caller to retry
+        if error.retryable or len(chunk) == 1 or depth >= MAX_SPLIT_DEPTH:
+            self._fail_entities(chunk, error, outcomes)
+            return
+
+        if error.entity_errors:
+            # The dry run named the entities it rejected - fail just those and submit the rest again
+            rejected = [entity for entity in chunk if entity["submitter_id"] in error.entity_errors]
+            accepted = [entity for entity in chunk if entity["submitter_id"] not in error.entity_errors]
+            if not rejected or not accepted:
+                self._fail_entities(chunk, error, outcomes)
+                return
+
+            logging.warning(f"GDC rejected {len(rejected)} of {len(chunk)} entities, submitting the rest again")
+            self._fail_entities(rejected, error, outcomes)
+            retry_error = self._attempt_chunk(accepted, outcomes)
+            if retry_error:
+                self._handle_rejected_chunk(accepted, retry_error, outcomes, depth + 1)
+            return
+
+        # Nothing says which entities are at fault, so split the transaction in half to find out
+        middle = len(chunk) // 2
+        halves = [chunk[:middle], chunk[middle:]]
+        logging.warning(f"Transaction of {len(chunk)} entities was rejected, splitting it to find the bad ones")
+        errors = [self._attempt_chunk(half, outcomes) for half in halves]
+
+        if all(errors) and errors[0].signature == errors[1].signature:
+            # Both halves failed the same way, so the problem is common to all of them (e.g. a missing link or
+            # a permission error) and splitting further would only cost more transactions
+            self._fail_entities(chunk, errors[0], outcomes)
+            return
+
+        for half, half_error in zip(halves, errors):
+            if half_error:
+                self._handle_rejected_chunk(half, half_error, outcomes, depth + 1)
+
+
+class AsyncRateLimiter:
+    """Token bucket that caps the combined request rate of every AsyncGdcApiWrapper it is passed to"""
+
+    def __init__(self, requests_per_second=ASYNC_REQUESTS_PER_SECOND, burst=None):
+        self.rate = requests_per_second
+        self.capacity = burst or requests_per_second
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        # Created on first use so the lock belongs to the event loop that is actually running
+        self._lock = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncGdcApiWrapper(GdcRequestBuilder):
+    """asyncio counterpart of GdcApiWrapper for sweeps that make many independent GDC calls.
+
+    Use it as an async context manager. At most max_concurrency requests are in flight at once, and
+    passing the same AsyncRateLimiter to several clients keeps them under one shared request rate.
+    Failed requests are retried with the same policy as the synchronous session: reads are retried on
+    429/5xx, connection errors and timeouts, while submission PUTs are only retried if they could not connect.
+    """
+
+    def __init__(self, program=None, project=None, token=None, max_concurrency=ASYNC_MAX_CONCURRENCY, rate_limiter=None,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff_factor=BACKOFF_FACTOR, validate_locally=True, query_read_timeout=QUERY_READ_TIMEOUT,
+                 max_retry_duration=MAX_RETRY_DURATION):
+        self.endpoint = 'https://api.gdc.cancer.gov/v0/submission'
+        self.program = program
+        self.project = project
+        self.token = token
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.query_read_timeout = query_read_timeout
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_duration = max_retry_duration
+        self.validate_locally = validate_locally
+        self.last_transaction_id = None
+        self._client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.query_read_timeout),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._client.close()
+
+    def _get_retry_delay(self, attempt, retry_after):
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        backoff = self.backoff_factor * (2 ** attempt)
+        return random.uniform(backoff / 2, backoff)
+
+    async def _request(self, method, url, **kwargs):
+        """Sends a request and returns (status, body text).
+
+        GETs and GraphQL POSTs are retried on 429/5xx, connection errors and timeouts. PUTs change state in GDC,
+        so they are only retried when the connection couldn't be made at all, and get the longer read timeout.
+        Retrying stops after max_retries or once max_retry_duration has passed since the first failure.
+        """
+        idempotent = method in ("GET", "POST")
+        if not idempotent:
+            kwargs.setdefault("timeout", aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout))
+
+        first_failure_at = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            last_response = None
+            try:
+                async with self._semaphore:
+                    if self.rate_limiter:
+                        await self.rate_limiter.acquire()
+
+                    async with self._client.request(method, url, headers=self.get_headers(), **kwargs) as response:
+                        status = response.status
+                        body = await response.text()
+                        retry_after = response.headers.get("Retry-After")
+            except aiohttp.ClientConnectorError as e:
+                # Nothing reached GDC, so this is safe to retry for any method
+                failure = f"could not connect ({e})"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not idempotent:
+                    raise
+                failure = f"{type(e).__name__} {e}"
+            else:
+                if status not in RETRY_STATUS_CODES or not idempotent:
+                    return status, body
+                failure = f"status {status}"
+                last_response = (status, body)
+
+            now = time.monotonic()
+            first_failure_at = first_failure_at or now
+            out_of_time = now - first_failure_at > self.max_retry_duration
+            if attempt == self.max_retries or out_of_time:
+                # Like the synchronous session, hand back the last response rather than raising on its status
+                if last_response:
+                    return last_response
+                raise aiohttp.ClientError(f"Giving up on {method} {url} after {attempt + 1} attempts: {failure}")
+
+            delay = self._get_retry_delay(attempt, retry_after)
+            logging.warning(f"GDC request {method} {url} failed with {failure}, retrying in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
+    async def get_entity(self, query_type, submitter_id):
+        """Runs a single GraphQL lookup and returns the decoded response"""
+        _, body = await self._request(
+            "POST", f"{self.endpoint}/graphql", json=self.construct_query(query_type, submitter_id)
+        )
+        return json.loads(body)
+
+    async def get_entities(self, query_type, submitter_ids, chunk_size=GRAPHQL_BATCH_SIZE):
+        """Same as GdcApiWrapper.get_entities, with the chunks queried concurrently"""
+        submitter_ids = list(dict.fromkeys(submitter_ids))
+        chunks = [submitter_ids[start:start + chunk_size] for start in range(0, len(submitter_ids), chunk_size)]
+
+        async def query_chunk(chunk):
+            _, body = await self._request(
+                "POST", f"{self.endpoint}/graphql", json=self.construct_batch_query(query_type, chunk)
+            )
+            response_json = json.loads(body)
+            if not response_json.get("data"):
+                raise RuntimeError(f"Data was not returned from GDC properly - {response_json}")
+            return {submitter_id: response_json["data"].get(f"q{index}") or [] for index, submitter_id in enumerate(chunk)}
+
+        entities = {}
+        for chunk_entities in await asyncio.gather(*(query_chunk(chunk) for chunk in chunks)):
+            entities.update(chunk_entities)
+        return entities
+
+    async def get_manifest(self, ids):
+        """Retrieves the gdc-client upload manifest (yaml) for the given entity UUIDs"""
+        status, body = await self._request(
+            "GET", f"{self.endpoint}/{self.program}/{self.project}/manifest", params={"ids": ",".join(ids)}
+        )
+        if status >= 400:
+            raise RuntimeError(f"Could not retrieve manifest for {ids}, status {status} - {body}")
+        return body
+
+    async def submit_metadata(self, metadata):
+        """Submits the formatted metadata to GDC API"""
+        url = f"{self.endpoint}/{self.program}/{self.project}"
+
+        if self.validate_locally:
+            invalid = self.validate_metadata(metadata)
+            if invalid:
+                raise GdcSubmissionError(f"Metadata failed validation against the GDC dictionary: {invalid}")
+
+        logging.info(
+            f"Submitting metadata to GDC dry_run endpoint for program {self.program} in project {self.project}"
+        )
+        try:
+            dry_run_status, body = await self._request("PUT", f"{url}/_dry_run", data=json.dumps(metadata))
+            dry_run_response = json.loads(body)
+
+            logging.info(f"Response for the dry commit: {dry_run_response}")
+            transaction_id = dry_run_response.get("transaction_id")
+            operation = "commit" if dry_run_response.get("success") else "close"
+
+            status, body = await self._request("PUT", f"{url}/transactions/{transaction_id}/{operation}")
+            logging.info(f"Response for the '{operation}' operation: {status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Same as the synchronous wrapper - GDC being unreachable is worth another attempt later
+            raise GdcSubmissionError(f"Error: {e}", retryable=True)
+        except ValueError as e:
+            raise GdcSubmissionError(f"Error: {e}")
+
+        if operation == "close":
+            raise GdcSubmissionError.from_dry_run(dry_run_response, dry_run_status)
+        if status >= 400:
+            raise GdcSubmissionError(f"Could not commit transaction {transaction_id}: {body}", status_code=status)
+        self.last_transaction_id = transaction_id
+        return operation
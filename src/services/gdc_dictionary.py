@@ -0,0 +1,233 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+import requests
+
+logging.basicConfig(
+    format="%(levelname)s: %(asctime)s : %(message)s", level=logging.INFO
+)
+
+GDC_DICTIONARY_ENDPOINT = "https://api.gdc.cancer.gov/v0/submission/_dictionary"
+GDC_DICTIONARY_CACHE_DIR = os.environ.get("GDC_DICTIONARY_CACHE_DIR", "/tmp/gdc_dictionary_cache")
+# How long a cached copy is used without checking GDC for a newer dictionary, in seconds
+GDC_DICTIONARY_CACHE_TTL = int(os.environ.get("GDC_DICTIONARY_CACHE_TTL", 24 * 60 * 60))
+# The entities we submit, or link our submissions to
+DICTIONARY_ENTITIES = ("read_group", "submitted_aligned_reads", "aliquot", "sample", "case")
+REQUEST_TIMEOUT = (10, 60)  # in seconds
+
+JSON_SCHEMA_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "array": (list,),
+    "object": (dict,),
+    "null": (type(None),),
+}
+
+
+class PropertyValidator:
+    """Checks a single property against the parts of its dictionary definition that can be checked offline"""
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.enum = set(definition["enum"]) if "enum" in definition else None
+        self.pattern = re.compile(definition["pattern"]) if "pattern" in definition else None
+        self.minimum = definition.get("minimum")
+        self.maximum = definition.get("maximum")
+
+        schema_types = definition.get("type")
+        if isinstance(schema_types, str):
+            schema_types = [schema_types]
+        self.types = set(schema_types) if schema_types else None
+
+    def _matches_type(self, value):
+        for schema_type in self.types:
+            python_types = JSON_SCHEMA_TYPES.get(schema_type, (object,))
+            # bool is a subclass of int in python, but not in JSON
+            if isinstance(value, python_types) and not (isinstance(value, bool) and schema_type in ("integer", "number")):
+                return True
+        return False
+
+    def validate(self, value):
+        if self.types and not self._matches_type(value):
+            return f"'{self.name}' must be of type {' or '.join(sorted(self.types))}, got {value!r}"
+        if self.enum is not None and value not in self.enum:
+            return f"'{self.name}' must be one of {sorted(self.enum, key=str)}, got {value!r}"
+        if self.pattern and isinstance(value, str) and not self.pattern.search(value):
+            return f"'{self.name}' must match '{self.pattern.pattern}', got {value!r}"
+        if self.minimum is not None and isinstance(value, (int, float)) and value < self.minimum:
+            return f"'{self.name}' must be at least {self.minimum}, got {value!r}"
+        if self.maximum is not None and isinstance(value, (int, float)) and value > self.maximum:
+            return f"'{self.name}' must be at most {self.maximum}, got {value!r}"
+        return None
+
+
+class EntityValidator:
+    """Validator compiled once from an entity's dictionary schema"""
+
+    def __init__(self, entity_type, schema):
+        self.entity_type = entity_type
+        self.required = list(schema.get("required", []))
+        self.allow_additional = schema.get("additionalProperties", True)
+        self.link_names = set(self._get_link_names(schema.get("links", [])))
+
+        self.known_properties = set(schema.get("properties", {})) | self.link_names
+        # Definitions that only point at shared _definitions.yaml entries can't be resolved offline, so GDC checks those
+        self.property_validators = {
+            name: PropertyValidator(name, definition)
+            for name, definition in schema.get("properties", {}).items()
+            if name not in self.link_names and isinstance(definition, dict) and "$ref" not in definition
+        }
+
+    @classmethod
+    def _get_link_names(cls, links):
+        for link in links:
+            if "subgroup" in link:
+                yield from cls._get_link_names(link["subgroup"])
+            elif "name" in link:
+                yield link["name"]
+
+    def validate(self, entity):
+        """Returns a list of problems with the entity, which is empty if it looks valid"""
+        errors = []
+
+        if entity.get("type") != self.entity_type:
+            errors.append(f"'type' must be '{self.entity_type}', got {entity.get('type')!r}")
+        for name in self.required:
+            if name not in entity:
+                errors.append(f"Missing required property '{name}'")
+
+        for name, value in entity.items():
+            if name in self.link_names:
+                links = value if isinstance(value, list) else [value]
+                if not all(isinstance(link, dict) and ("submitter_id" in link or "id" in link) for link in links):
+                    errors.append(f"Link '{name}' must reference entities by 'submitter_id' or 'id'")
+            elif name in self.property_validators:
+                error = self.property_validators[name].validate(value)
+                if error:
+                    errors.append(error)
+            elif name not in self.known_properties and not self.allow_additional:
+                errors.append(f"Unknown property '{name}'")
+
+        return errors
+
+
+class GdcDictionary:
+    """Local, versioned copy of the GDC data dictionary schemas we submit against.
+
+    The dictionary can change without a new API release, so the version is a hash of the schema content itself
+    rather than anything /status reports. Schemas are kept in cache_dir under that hash, and a copy checked
+    against GDC less than cache_ttl seconds ago is used without any request. Older copies are downloaded again,
+    and if GDC can't be reached, the newest cached version is used whatever its age.
+    """
+
+    def __init__(self, cache_dir=GDC_DICTIONARY_CACHE_DIR, session=None, cache_ttl=GDC_DICTIONARY_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self._session = session
+        self.version = None
+        self.schemas = None
+        self._validators = {}
+
+    @property
+    def session(self):
+        if self._session is None:
+            # Imported here since gdc_api imports this module. Only made when the schemas have to be downloaded.
+            from src.services.gdc_api import create_session
+            self._session = create_session()
+        return self._session
+
+    @staticmethod
+    def _get_content_version(schemas):
+        content = json.dumps(schemas, sort_keys=True, separators=(",", ":")).encode()
+        return hashlib.sha256(content).hexdigest()[:16]
+
+    def _get_newest_cached_version(self):
+        if not os.path.isdir(self.cache_dir):
+            return None
+        cached = [f for f in os.listdir(self.cache_dir) if f.endswith(".json")]
+        if not cached:
+            return None
+        newest = max(cached, key=lambda f: os.path.getmtime(os.path.join(self.cache_dir, f)))
+        return newest[:-len(".json")]
+
+    def _read_cached_schemas(self, version):
+        with open(os.path.join(self.cache_dir, f"{version}.json"), "r") as f:
+            return json.load(f)
+
+    def _get_cache_age(self, version):
+        return time.time() - os.path.getmtime(os.path.join(self.cache_dir, f"{version}.json"))
+
+    def _download_schemas(self):
+        schemas = {}
+        for entity_type in DICTIONARY_ENTITIES:
+            response = self.session.get(f"{GDC_DICTIONARY_ENDPOINT}/{entity_type}", timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            schemas[entity_type] = response.json()
+        return schemas
+
+    def _save_to_cache(self, version, schemas):
+        cache_path = os.path.join(self.cache_dir, f"{version}.json")
+        if os.path.exists(cache_path):
+            # Mark it as just checked against GDC, and as the newest version we've seen
+            os.utime(cache_path)
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(schemas, f)
+        os.replace(tmp_path, cache_path)
+
+    def load(self):
+        if self.schemas is not None:
+            return self
+
+        cached_version = self._get_newest_cached_version()
+        if cached_version is not None and self._get_cache_age(cached_version) < self.cache_ttl:
+            self.version = cached_version
+            self.schemas = self._read_cached_schemas(cached_version)
+            return self
+
+        try:
+            schemas = self._download_schemas()
+        except requests.exceptions.RequestException as e:
+            version = cached_version
+            if version is None:
+                raise
+            logging.warning(f"Could not download the GDC dictionary ({e}), using cached version {version}")
+            schemas = self._read_cached_schemas(version)
+        else:
+            version = self._get_content_version(schemas)
+            logging.info(f"Using GDC dictionary version {version}")
+            self._save_to_cache(version, schemas)
+
+        self.version = version
+        self.schemas = schemas
+        return self
+
+    def get_validator(self, entity_type):
+        if entity_type not in self._validators:
+            self.load()
+            if entity_type not in self.schemas:
+                return None
+            self._validators[entity_type] = EntityValidator(entity_type, self.schemas[entity_type])
+        return self._validators[entity_type]
+
+    def validate(self, entity):
+        """Returns a list of problems with the entity. Entity types outside DICTIONARY_ENTITIES are left to GDC."""
+        validator = self.get_validator(entity.get("type"))
+        return validator.validate(entity) if validator else []
+
+
+@functools.lru_cache(maxsize=None)
+def get_gdc_dictionary(cache_dir=GDC_DICTIONARY_CACHE_DIR):
+    """Returns the process-wide dictionary for cache_dir, so schemas are loaded and compiled only once"""
+    return GdcDictionary(cache_dir=cache_dir)
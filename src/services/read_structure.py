@@ -0,0 +1,88 @@
+import functools
+import re
+from collections import namedtuple
+
+# A read structure is a list of <cycles><type> segments, e.g. 3M2S71T8B8B3M2S71T
+SEGMENT_PATTERN = re.compile(r"(\d+)([TBMS])")
+READ_STRUCTURE_PATTERN = re.compile(r"(?:\d+[TBMS])*")
+SEGMENT_TYPES = {
+    "T": "template",
+    "B": "barcode",
+    "M": "molecular",
+    "S": "skip",
+}
+
+ReadSegment = namedtuple("ReadSegment", ["length", "type"])
+
+
+class ReadStructure:
+    """A parsed read structure.
+
+    A template read is a T segment together with the M (UMI) and S (skip) segments directly in front of it, since
+    those cycles are sequenced as part of the same read. Barcode segments are index reads and never count.
+
+    A read's cycle length counts all of those cycles, while its template length only counts the T cycles - what
+    is left of the read once Picard has moved the M cycles into the RX tag and dropped the S cycles.
+    """
+
+    def __init__(self, read_structure, segments):
+        self.read_structure = read_structure
+        self.segments = tuple(segments)
+        self.template_reads = self._group_template_reads(self.segments)
+        self.cycle_lengths = tuple(sum(segment.length for segment in read) for read in self.template_reads)
+        self.template_lengths = tuple(
+            sum(segment.length for segment in read if segment.type == "template") for read in self.template_reads
+        )
+
+    @staticmethod
+    def _group_template_reads(segments):
+        template_reads = []
+        current_read = []
+        for segment in segments:
+            if segment.type == "barcode":
+                current_read = []
+            else:
+                current_read.append(segment)
+                if segment.type == "template":
+                    template_reads.append(tuple(current_read))
+                    current_read = []
+        return tuple(template_reads)
+
+    @property
+    def cycle_length(self):
+        """Cycles in the first template read, e.g. 76 for both 76T8B8B76T and 3M2S71T8B8B3M2S71T, or 0 if there is none"""
+        return self.cycle_lengths[0] if self.cycle_lengths else 0
+
+    @property
+    def template_length(self):
+        """T cycles in the first template read, e.g. 76 for 76T8B8B76T but 71 for 3M2S71T8B8B3M2S71T, or 0 if there is none"""
+        return self.template_lengths[0] if self.template_lengths else 0
+
+    @property
+    def spot_length(self):
+        """T cycles in all the template reads together, i.e. the bases of a spot once UMIs and skips are removed"""
+        return sum(self.template_lengths)
+
+    @property
+    def layout(self):
+        """The segment types in order, e.g. ('template', 'barcode', 'barcode', 'template')"""
+        return tuple(segment.type for segment in self.segments)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_read_structure(read_structure):
+    """Parses a read structure string. Each distinct string is only parsed once per process."""
+    if not READ_STRUCTURE_PATTERN.fullmatch(read_structure):
+        raise ValueError(f"Invalid read structure: '{read_structure}'")
+
+    segments = [
+        ReadSegment(int(length), SEGMENT_TYPES[segment_type])
+        for length, segment_type in SEGMENT_PATTERN.findall(read_structure)
+    ]
+    return ReadStructure(read_structure, segments)
+
+
+def get_read_length(read_structure):
+    """The read length we report to both GDC and dbGaP: the template length of the first template read, which is
+    the length of the reads in the submitted file, e.g. 76 for 76T8B8B76T and 8B76T but 71 for 3M2S71T8B8B3M2S71T"""
+    return parse_read_structure(read_structure).template_length
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+logging.basicConfig(
+    format="%(levelname)s: %(asctime)s : %(message)s", level=logging.INFO
+)
+
+SUBMISSION_LEDGER_PATH = "/cromwell_root/submission_ledger.db"
+
+
+class SubmissionLedger:
+    """SQLite record of the entities we have committed to GDC, keyed by program/project/submitter_id.
+
+    The file is small enough to hand from one task attempt or workflow run to the next, so a rerun can skip
+    anything that was already committed with an identical payload instead of going through a dry run again.
+    """
+
+    def __init__(self, path=SUBMISSION_LEDGER_PATH):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS committed_entities (
+                    program TEXT NOT NULL,
+                    project TEXT NOT NULL,
+                    submitter_id TEXT NOT NULL,
+                    payload_hash TEXT NOT NULL,
+                    transaction_id TEXT,
+                    uuid TEXT,
+                    committed_at REAL NOT NULL,
+                    PRIMARY KEY (program, project, submitter_id)
+                )"""
+            )
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @staticmethod
+    def hash_payload(entity):
+        return hashlib.sha256(json.dumps(entity, sort_keys=True).encode()).hexdigest()
+
+    def get_committed(self, program, project, submitter_ids):
+        """Returns {submitter_id: ledger row} for the given submitter_ids that have been committed"""
+        submitter_ids = list(submitter_ids)
+        committed = {}
+        with self._connect() as connection:
+            # Stay well under SQLite's limit on the number of query parameters
+            for start in range(0, len(submitter_ids), 500):
+                chunk = submitter_ids[start:start + 500]
+                rows = connection.execute(
+                    f"""SELECT * FROM committed_entities WHERE program = ? AND project = ?
+                        AND submitter_id IN ({','.join('?' * len(chunk))})""",
+                    (program, project, *chunk)
+                )
+                committed.update({row["submitter_id"]: dict(row) for row in rows})
+        return committed
+
+    def record_commit(self, program, project, entities, transaction_id=None):
+        with self._connect() as connection:
+            connection.executemany(
+                """INSERT INTO committed_entities (program, project, submitter_id, payload_hash, transaction_id, committed_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (program, project, submitter_id) DO UPDATE SET
+                       payload_hash = excluded.payload_hash,
+                       transaction_id = excluded.transaction_id,
+                       committed_at = excluded.committed_at""",
+                [
+                    (program, project, entity["submitter_id"], self.hash_payload(entity), transaction_id, time.time())
+                    for entity in entities
+                ]
+            )
+
+    def record_uuid(self, program, project, submitter_id, uuid):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE committed_entities SET uuid = ? WHERE program = ? AND project = ? AND submitter_id = ?",
+                (uuid, program, project, submitter_id)
+            )
+
+    def get_uncommitted(self, gdc_wrapper, entities, query_type):
+        """Returns the entities that still need to be submitted.
+
+        An entity is skipped only if the ledger has it committed with the same payload hash AND a batched
+        query shows GDC still has it, so a ledger from a different environment can't hide missing data.
+        """
+        program, project = gdc_wrapper.program, gdc_wrapper.project
+        committed = self.get_committed(program, project, [entity["submitter_id"] for entity in entities])
+        unchanged = [
+            entity["submitter_id"] for entity in entities
+            if entity["submitter_id"] in committed
+            and committed[entity["submitter_id"]]["payload_hash"] == self.hash_payload(entity)
+        ]
+
+        existing = gdc_wrapper.get_entities(query_type, unchanged) if unchanged else {}
+        already_committed = {submitter_id for submitter_id in unchanged if existing.get(submitter_id)}
+        if already_committed:
+            logging.info(f"Skipping {len(already_committed)} entities already committed with identical metadata")
+
+        return [entity for entity in entities if entity["submitter_id"] not in already_committed]
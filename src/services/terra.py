@@ -1,65 +1,233 @@
+import gzip
+import os
+import tempfile
+import ijson
 import requests
 import json
-from oauth2client.client import GoogleCredentials
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from src.services import credentials
+
+PAGE_SIZE = 100
+SNAPSHOT_PAGE_SIZE = 1000  # whole-table downloads use bigger pages since they aren't filtered
+MAX_PAGE_WORKERS = 8  # pages of an entityQuery fetched at the same time
+ENTITY_SNAPSHOT_DIR = os.environ.get("TERRA_ENTITY_SNAPSHOT_DIR", "/tmp/terra_entity_snapshots")
+
+
+class EntityTableSnapshot:
+    """In-memory copy of a whole entity table, indexed by entity name and attribute values.
+
+    Unlike entityQuery's filterTerms, which matches substrings, lookups match whole values - which is what
+    sample ids and aliases are.
+    """
+
+    def __init__(self, table, version, entities, index_attributes=None):
+        self.table = table
+        self.version = version
+        self.entities = entities
+        self._index = defaultdict(list)
+
+        for position, entity in enumerate(entities):
+            keys = {entity.get("name")}
+            for attribute, value in entity.get("attributes", {}).items():
+                if isinstance(value, str) and (index_attributes is None or attribute in index_attributes):
+                    keys.add(value)
+            for key in keys:
+                self._index[key].append(position)
+
+    def lookup(self, sample_id):
+        """Returns the entities whose name or an attribute equals sample_id, like call_terra_api does"""
+        return [self.entities[position] for position in self._index.get(sample_id, [])]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        # GzipFile doesn't close a file object it is given, so close the file separately
+        with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+            f.write(json.dumps({"table": self.table, "version": self.version}) + "\n")
+            for entity in self.entities:
+                f.write(json.dumps(entity, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, index_attributes=None):
+        with gzip.open(path, "rt") as f:
+            header = json.loads(f.readline())
+            entities = [json.loads(line) for line in f]
+        return cls(header["table"], header["version"], entities, index_attributes=index_attributes)
+
+
+def project_attributes(entity, attributes):
+    """Returns a copy of the entity that only keeps the given attributes"""
+    if attributes is None:
+        return entity
+    entity_attributes = entity.get("attributes", {})
+    return {
+        **entity,
+        "attributes": {name: entity_attributes[name] for name in attributes if name in entity_attributes}
+    }
+
 
 class TerraAPIWrapper:
-    def __init__(self, billing_project=None, workspace_name=None):
+    def __init__(self, billing_project=None, workspace_name=None, page_size=PAGE_SIZE, max_workers=MAX_PAGE_WORKERS,
+                 use_snapshots=False, snapshot_dir=ENTITY_SNAPSHOT_DIR):
         self.base_url = "https://api.firecloud.org/api/workspaces"
         self.billing_project = billing_project
         self.workspace_name = workspace_name
+        self.page_size = page_size
+        self.max_workers = max_workers
+        # With snapshots on, call_terra_api downloads each table once and answers every lookup from memory
+        self.use_snapshots = use_snapshots
+        self.snapshot_dir = snapshot_dir
+        self._snapshots = {}
+
+        # One keep-alive connection per worker, shared by every page request
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=max_workers))
 
     def get_access_token(self):
         """Get access token."""
-        scopes = ["https://www.googleapis.com/auth/userinfo.profile", "https://www.googleapis.com/auth/userinfo.email"]
-        credentials = GoogleCredentials.get_application_default()
-        credentials = credentials.create_scoped(scopes)
-
-        return credentials.get_access_token().access_token
+        return credentials.get_access_token()
 
     def get_headers(self):
         return {
             "Authorization": "Bearer " + self.get_access_token(),
-            "accept": "*/*", 
+            "accept": "*/*",
             "Content-Type": "application/json"
         }
 
- 
-    def call_terra_api(self, sample_id, table):
+    @staticmethod
+    def _get_page_parameters(filter_terms, page_number, page_size, attributes):
+        parameters = {
+            'page': page_number,
+            'pageSize': page_size,
+            'filterTerms': filter_terms
+        }
+        if attributes is not None:
+            # Ask the server to only send these attributes back
+            parameters['fields'] = ",".join(attributes)
+        return parameters
+
+    def _get_entity_page(self, url, headers, filter_terms, page_number, page_size, attributes=None):
+        parameters = self._get_page_parameters(filter_terms, page_number, page_size, attributes)
+
+        response = self.session.get(url, headers=headers, params=parameters)
+        response.raise_for_status()
+        return response.json()
+
+    def _stream_entity_page(self, url, headers, filter_terms, page_number, page_size, attributes, page_metadata):
+        """Yields the entities of one page as they are decoded from the response, without holding the whole page.
+        The page's resultMetadata is stored in page_metadata once it has been read."""
+        parameters = self._get_page_parameters(filter_terms, page_number, page_size, attributes)
+
+        with self.session.get(url, headers=headers, params=parameters, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            builder = None
+            # use_float so numbers come back as int/float like response.json() gives, not Decimal
+            for prefix, event, value in ijson.parse(response.raw, use_float=True):
+                if prefix == "resultMetadata.filteredPageCount":
+                    page_metadata["filteredPageCount"] = value
+                elif prefix == "results.item" and event == "start_map":
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif builder is not None:
+                    builder.event(event, value)
+                    if prefix == "results.item" and event == "end_map":
+                        yield builder.value
+                        builder = None
+
+    def _get_projected_page(self, url, headers, filter_terms, page_number, page_size, attributes):
+        """Returns (entities, filteredPageCount) for one page, projecting each entity as it is decoded so the
+        unrequested attributes of a wide table are never held in memory, even if the server ignores fields"""
+        page_metadata = {}
+        entities = [
+            project_attributes(entity, attributes)
+            for entity in self._stream_entity_page(
+                url, headers, filter_terms, page_number, page_size, attributes, page_metadata
+            )
+        ]
+        return entities, page_metadata.get("filteredPageCount", 0)
+
+    def _query_entities(self, table, filter_terms, page_size, attributes=None):
+        """Reads the first page to learn how many pages there are, then fetches the rest concurrently"""
+        headers = self.get_headers()
+        workspace_url = f"{self.base_url}/{self.billing_project}/{self.workspace_name}/entityQuery/{table}"
+
+        if attributes is None:
+            def get_page(page_number):
+                page = self._get_entity_page(workspace_url, headers, filter_terms, page_number, page_size)
+                return page.get('results') or [], page.get('resultMetadata', {}).get('filteredPageCount', 1)
+        else:
+            def get_page(page_number):
+                return self._get_projected_page(workspace_url, headers, filter_terms, page_number, page_size, attributes)
+
+        results, filtered_page_count = get_page(1)
+        results = list(results)
+
+        if filtered_page_count > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, filtered_page_count - 1)) as executor:
+                # map hands the pages back in order, however they complete
+                for page_results, _ in executor.map(get_page, range(2, filtered_page_count + 1)):
+                    results.extend(page_results)
+
+        return results
+
+    def call_terra_api(self, sample_id, table, attributes=None):
         """
         Call the Terra API to retrieve reads data.
 
         Args:
             sample_id (str): The sample ID to filter by.
             table (str): The table name.
+            attributes (list): Optional allow-list of attributes to fetch and keep.
 
         Returns:
-            list: A list of results from the API.
+            list: A list of results from the API, in page order.
         """
-        results = []
-        page_number = 1
-        headers = self.get_headers()
-        workspace_url = f"{self.base_url}/{self.billing_project}/{self.workspace_name}/entityQuery/{table}"
+        if self.use_snapshots:
+            return [project_attributes(entity, attributes) for entity in self.get_table_snapshot(table).lookup(sample_id)]
 
-        while True:
-            parameters = {
-                'page': page_number,
-                'pageSize': 100,
-                'filterTerms': sample_id
-            }
+        return self._query_entities(table, sample_id, self.page_size, attributes)
 
-            response = requests.get(workspace_url, headers=headers, params=parameters)
-            response.raise_for_status()
-            data = response.json()
+    def get_workspace_last_modified(self):
+        """Returns the workspace's lastModified timestamp, which changes whenever its entities do"""
+        response = self.session.get(
+            f"{self.base_url}/{self.billing_project}/{self.workspace_name}",
+            headers=self.get_headers(),
+            params={"fields": "workspace.lastModified"}
+        )
+        response.raise_for_status()
+        return response.json()["workspace"]["lastModified"]
+
+    def get_table_snapshot(self, table, refresh=False):
+        """
+        Returns a snapshot of the whole table, downloading it only if the workspace changed since it was saved.
+
+        Args:
+            table (str): The table name.
+            refresh (bool): Check the workspace for changes even if this wrapper already holds a snapshot.
+
+        Returns:
+            EntityTableSnapshot: The table, indexed for lookups by sample id or alias.
+        """
+        if table in self._snapshots and not refresh:
+            return self._snapshots[table]
 
-            if data.get('results'):
-                results.extend(data['results'])
-                page_number += 1
+        snapshot_path = os.path.join(self.snapshot_dir, self.billing_project, self.workspace_name, f"{table}.json.gz")
+        version = self.get_workspace_last_modified()
 
-                # Check if the next page exists based on metadata
-                metadata = data.get('resultMetadata', {})
-                filtered_page_count = metadata.get('filteredPageCount', 0)
+        snapshot = self._snapshots.get(table)
+        if (snapshot is None or snapshot.version != version) and os.path.exists(snapshot_path):
+            snapshot = EntityTableSnapshot.load(snapshot_path)
 
-                if page_number >= filtered_page_count:
-                    break
+        if snapshot is None or snapshot.version != version:
+            print(f"Downloading a snapshot of the '{table}' table")
+            snapshot = EntityTableSnapshot(table, version, self._query_entities(table, None, SNAPSHOT_PAGE_SIZE))
+            snapshot.save(snapshot_path)
 
-        return results
\ No newline at end of file
+        self._snapshots[table] = snapshot
+        return snapshot